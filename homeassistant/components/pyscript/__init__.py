@@ -2,24 +2,26 @@
 
 from collections import OrderedDict
 import glob
+import importlib
 import io
 import logging
 import os
 
+import voluptuous as vol
 import yaml
 
-from homeassistant.components.pyscript.eval import AstEval, EvalFunc
+from homeassistant.components.pyscript.eval import ALLOWED_IMPORTS, AstEval, EvalFunc
 from homeassistant.components.pyscript.event import Event
-from homeassistant.components.pyscript.handler import Handler
+from homeassistant.components.pyscript.handler import LOW_PRIORITY_MAX, Handler
 from homeassistant.components.pyscript.state import State
 from homeassistant.components.pyscript.trigger import TrigInfo, TrigTime
 from homeassistant.const import (
     EVENT_HOMEASSISTANT_STARTED,
     EVENT_HOMEASSISTANT_STOP,
-    EVENT_STATE_CHANGED,
     SERVICE_RELOAD,
 )
 from homeassistant.exceptions import HomeAssistantError
+import homeassistant.helpers.config_validation as cv
 from homeassistant.helpers.service import async_set_service_schema
 from homeassistant.loader import bind_hass
 
@@ -29,16 +31,61 @@ DOMAIN = "pyscript"
 
 FOLDER = "pyscript"
 
+CONF_NOTIFY_QUEUE_MAX = "notify_queue_max"
+CONF_LOW_PRIORITY_MAX = "low_priority_max"
+CONF_LAG_MAX = "lag_max"
+CONF_ALLOW_NUMPY = "allow_numpy"
+CONF_STATE_SET_DELAY = "state_set_delay"
+
+TASK_MODES = {"single", "queued", "restart", "parallel"}
+
+TASK_MODE_MAX_DEFAULT = 10
+
+TASK_PRIORITIES = {"high", "normal", "low"}
+
+CONFIG_SCHEMA = vol.Schema(
+    {
+        DOMAIN: vol.Schema(
+            {
+                vol.Optional(CONF_NOTIFY_QUEUE_MAX, default=0): cv.positive_int,
+                vol.Optional(CONF_LOW_PRIORITY_MAX, default=LOW_PRIORITY_MAX): vol.All(
+                    vol.Coerce(int), vol.Range(min=1)
+                ),
+                vol.Optional(CONF_LAG_MAX, default=0): cv.positive_float,
+                vol.Optional(CONF_ALLOW_NUMPY, default=False): cv.boolean,
+                vol.Optional(CONF_STATE_SET_DELAY, default=0): cv.positive_float,
+            }
+        )
+    },
+    extra=vol.ALLOW_EXTRA,
+)
+
 
 async def async_setup(hass, config):
     """Initialize the pyscript component."""
 
-    handler_func = Handler(hass)
-    event_func = Event(hass)
+    conf = config.get(DOMAIN, {})
+    handler_func = Handler(
+        hass,
+        notify_queue_max=conf.get(CONF_NOTIFY_QUEUE_MAX, 0),
+        low_priority_max=conf.get(CONF_LOW_PRIORITY_MAX, LOW_PRIORITY_MAX),
+        lag_max=conf.get(CONF_LAG_MAX, 0),
+    )
+    event_func = Event(hass, handler_func)
+    event_func.register_functions()
     trig_time_func = TrigTime(hass, handler_func)
-    state_func = State(hass, handler_func)
+    state_func = State(hass, handler_func, set_delay=conf.get(CONF_STATE_SET_DELAY, 0))
     state_func.register_functions()
 
+    if conf.get(CONF_ALLOW_NUMPY, False):
+        try:
+            state_func.numpy = await hass.async_add_executor_job(
+                importlib.import_module, "numpy"
+            )
+            ALLOWED_IMPORTS.add("numpy")
+        except ImportError:
+            _LOGGER.error("%s is set, but numpy isn't installed", CONF_ALLOW_NUMPY)
+
     path = hass.config.path(FOLDER)
 
     def check_isdir(path):
@@ -67,6 +114,9 @@ async def async_setup(hass, config):
         )
         for trig in triggers.values():
             await trig.stop()
+        trig_time_func.wait_expr_clear()
+        state_func.windows_clear()
+        state_func.set_flush()
         for name in services:
             hass.services.async_remove(DOMAIN, name)
         triggers, services = await compile_scripts(
@@ -81,31 +131,21 @@ async def async_setup(hass, config):
 
     hass.services.async_register(DOMAIN, SERVICE_RELOAD, reload_scripts_handler)
 
-    async def state_changed(event):
-        var_name = event.data["entity_id"]
-        # attr = event.data["new_state"].attributes
-        new_val = event.data["new_state"].state
-        old_val = event.data["old_state"].state if event.data["old_state"] else None
-        new_vars = {var_name: new_val, f"{var_name}.old": old_val}
-        func_args = {
-            "trigger_type": "state",
-            "var_name": var_name,
-            "value": new_val,
-            "old_value": old_val,
-        }
-        await state_func.update(new_vars, func_args)
-
     async def start_triggers(event):
-        _LOGGER.debug("adding state changed listener")
-        hass.bus.async_listen(EVENT_STATE_CHANGED, state_changed)
         _LOGGER.debug("starting triggers")
         for trig in triggers.values():
             trig.start()
+        handler_func.lag_monitor_start()
 
     async def stop_triggers(event):
         _LOGGER.debug("stopping triggers")
+        handler_func.lag_monitor_stop()
         for trig in triggers.values():
             await trig.stop()
+        #
+        # make any delayed state.set() writes before hass stops
+        #
+        state_func.set_flush()
 
     hass.bus.async_listen(EVENT_HOMEASSISTANT_STARTED, start_triggers)
     hass.bus.async_listen(EVENT_HOMEASSISTANT_STOP, stop_triggers)
@@ -113,6 +153,35 @@ async def async_setup(hass, config):
     return True
 
 
+def parse_task_mode(name, file, dec_args, dec_kwargs):
+    """Check the @task_mode decorator arguments, and return [mode, max_tasks] or None."""
+    if dec_args is None or len(dec_args) != 1 or dec_args[0] not in TASK_MODES:
+        _LOGGER.error(
+            "%s defined in %s: decorator @task_mode takes one argument, which should be one of %s; ignored",
+            name,
+            file,
+            ", ".join(sorted(TASK_MODES)),
+        )
+        return None
+    mode = dec_args[0]
+    max_tasks = (dec_kwargs or {}).get("max", TASK_MODE_MAX_DEFAULT)
+    if set(dec_kwargs or {}) - {"max"}:
+        _LOGGER.error(
+            "%s defined in %s: decorator @task_mode only takes a max keyword argument; ignored",
+            name,
+            file,
+        )
+        return None
+    if not isinstance(max_tasks, int) or max_tasks < 1:
+        _LOGGER.error(
+            "%s defined in %s: decorator @task_mode max should be a positive integer; ignored",
+            name,
+            file,
+        )
+        return None
+    return [mode, max_tasks]
+
+
 @bind_hass
 async def compile_scripts(
     hass, event_func=None, state_func=None, handler_func=None, trig_time_func=None
@@ -140,11 +209,7 @@ async def compile_scripts(
                 handler_func=handler_func,
             )
             handler_func.install_ast_funcs(ast_ctx)
-            func_args = {
-                "trigger_type": "service",
-            }
-            func_args = func_args.update(call.data)
-            handler_func.create_task(func.call(ast_ctx, [], call.data))
+            handler_func.create_task(func.call(ast_ctx, [], call.data), name=name)
 
         return pyscript_service_handler
 
@@ -222,15 +287,55 @@ async def compile_scripts(
                 "state_active",
                 "time_active",
             }
+            rate_kwargs = {"debounce", "throttle", "throttle_mode", "sample"}
+            trig_kwargs_valid = {
+                "state_trigger": {"state_hold", "state_hold_false"} | rate_kwargs,
+                "event_trigger": rate_kwargs,
+            }
+            has_task_mode = False
+            has_task_priority = False
             for dec in func.get_decorators():
-                dec_name, dec_args = dec[0], dec[1]
+                dec_name, dec_args, dec_kwargs = dec[0], dec[1], dec[2]
                 if dec_name in trig_decorators:
                     if dec_name not in trig_args:
                         trig_args[dec_name] = []
                     if dec_args is not None:
                         trig_args[dec_name] += dec_args
+                    for kwarg, value in (dec_kwargs or {}).items():
+                        if kwarg not in trig_kwargs_valid.get(dec_name, set()):
+                            _LOGGER.error(
+                                "%s defined in %s decorator @%s got unexpected keyword argument '%s'; ignored",
+                                name,
+                                file,
+                                dec_name,
+                                kwarg,
+                            )
+                            continue
+                        trig_args.setdefault(f"{dec_name}_kwargs", {})[kwarg] = value
+                elif dec_name == "task_mode":
+                    task_mode = parse_task_mode(name, file, dec_args, dec_kwargs)
+                    if task_mode is None:
+                        continue
+                    handler_func.task_mode_set(name, *task_mode)
+                    has_task_mode = True
+                elif dec_name == "task_priority":
+                    if (
+                        dec_args is None
+                        or len(dec_args) != 1
+                        or dec_args[0] not in TASK_PRIORITIES
+                        or dec_kwargs is not None
+                    ):
+                        _LOGGER.error(
+                            "%s defined in %s: decorator @task_priority takes one argument, which should be one of %s; ignored",
+                            name,
+                            file,
+                            ", ".join(sorted(TASK_PRIORITIES)),
+                        )
+                        continue
+                    handler_func.task_priority_set(name, dec_args[0])
+                    has_task_priority = True
                 elif dec_name == "service":
-                    if dec_args is not None:
+                    if dec_args is not None or dec_kwargs is not None:
                         _LOGGER.error(
                             "%s defined in %s: decorator @service takes no arguments; ignored",
                             name,
@@ -254,6 +359,10 @@ async def compile_scripts(
                         file,
                         dec_name,
                     )
+            if not has_task_mode:
+                handler_func.task_mode_set(name, None)
+            if not has_task_priority:
+                handler_func.task_priority_set(name, None)
             for dec_name in trig_decorators:
                 if dec_name in trig_args and len(trig_args[dec_name]) == 0:
                     trig_args[dec_name] = None
@@ -277,6 +386,8 @@ async def compile_scripts(
                         " or ".join([str(cnt) for cnt in sorted(arg_cnt)]),
                     )
                     del trig_args[dec_name]
+                    trig_args.pop(f"{dec_name}_kwargs", None)
+                    continue
                 if arg_cnt == 1:
                     trig_args[dec_name] = trig_args[dec_name][0]
 
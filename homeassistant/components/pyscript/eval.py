@@ -150,16 +150,28 @@ class EvalFunc:
                 args = []
                 for arg in dec.args:
                     args.append(await ast_ctx.aeval(arg))
-                self.decorators.append([dec.func.id, args])
+                kwargs = None
+                for keyword in dec.keywords:
+                    if keyword.arg is None:
+                        _LOGGER.error(
+                            "function %s decorator @%s doesn't support **kwargs",
+                            self.name,
+                            dec.func.id,
+                        )
+                        continue
+                    if kwargs is None:
+                        kwargs = {}
+                    kwargs[keyword.arg] = await ast_ctx.aeval(keyword.value)
+                self.decorators.append([dec.func.id, args, kwargs])
             elif isinstance(dec, ast.Name):
-                self.decorators.append([dec.id, None])
+                self.decorators.append([dec.id, None, None])
             else:
                 _LOGGER.error(
                     "function %s has unexpected decorator type %s", self.name, dec
                 )
 
     def get_decorators(self):
-        """Return the function decorators."""
+        """Return the function decorators, as a list of [name, args, kwargs]."""
         return self.decorators
 
     def get_doc_string(self):
@@ -178,7 +190,11 @@ class EvalFunc:
         sym_table = {}
         if args is None:
             args = []
-        kwargs = kwargs.copy() if kwargs else {}
+        #
+        # kwargs might be shared (eg, event data), so we don't modify it
+        #
+        if kwargs is None:
+            kwargs = {}
         for i in range(len(self.func_def.args.args)):
             var_name = self.func_def.args.args[i].arg
             val = None
@@ -190,7 +206,6 @@ class EvalFunc:
                     )
             elif var_name in kwargs:
                 val = kwargs[var_name]
-                del kwargs[var_name]
             elif self.num_posn_arg <= i < len(self.defaults) + self.num_posn_arg:
                 val = self.defaults[i - self.num_posn_arg]
             else:
@@ -202,7 +217,6 @@ class EvalFunc:
             var_name = self.func_def.args.kwonlyargs[i].arg
             if var_name in kwargs:
                 val = kwargs[var_name]
-                del kwargs[var_name]
             elif i < len(self.kw_defaults) and self.kw_defaults[i]["ok"]:
                 val = self.kw_defaults[i]["val"]
             else:
@@ -211,7 +225,16 @@ class EvalFunc:
                 )
             sym_table[var_name] = val
         if self.func_def.args.kwarg:
-            sym_table[self.func_def.args.kwarg.arg] = kwargs
+            #
+            # only **kwargs needs a copy of the remaining keyword arguments
+            #
+            arg_names = {
+                arg.arg
+                for arg in self.func_def.args.args + self.func_def.args.kwonlyargs
+            }
+            sym_table[self.func_def.args.kwarg.arg] = {
+                key: val for key, val in kwargs.items() if key not in arg_names
+            }
         if self.func_def.args.vararg:
             if len(args) > len(self.func_def.args.args):
                 sym_table[self.func_def.args.vararg.arg] = tuple(
@@ -256,10 +279,19 @@ class AstEval:
         self.sym_table_stack = []
         self.sym_table = self.global_sym_table
         self.local_sym_table = {}
+        #
+        # state variables or event data passed to eval(), which are looked up
+        # in place rather than copied into local_sym_table
+        #
+        self.notify_vars = None
         self.curr_func = None
         self.filename = ""
         self.exception = None
         self.exception_long = None
+        #
+        # set to False by callers that handle self.exception themselves
+        #
+        self.log_exceptions = True
         self.state = state_func
         self.handler = handler_func
         self.event = event_func
@@ -284,6 +316,8 @@ class AstEval:
             if hasattr(arg, "lineno"):
                 self.exception = f"Exception in {func_name}{self.filename} line {arg.lineno} column {arg.col_offset}: {err}"
                 self.exception_long = f"Exception in {func_name}{self.filename} line {arg.lineno} column {arg.col_offset}: {traceback.format_exc(0)}"
+                if not self.log_exceptions:
+                    return None
                 _LOGGER.error(
                     "Exception in %s%s line %s column %s: %s",
                     func_name,
@@ -295,6 +329,8 @@ class AstEval:
             else:
                 self.exception = f"Exception in {func_name}{self.filename}: {err}"
                 self.exception_long = f"Exception in {func_name}{self.filename}: {traceback.format_exc(0)}"
+                if not self.log_exceptions:
+                    return None
                 _LOGGER.error("Exception in %s%s: %s", func_name, self.filename, err)
         return None
 
@@ -351,18 +387,28 @@ class AstEval:
         """Execute for statement."""
         loop_var = await self.aeval(arg.target)
         loop_iter = await self.aeval(arg.iter)
-        for i in loop_iter:
-            self.sym_table[loop_var] = i
-            for arg1 in arg.body:
-                val = await self.aeval(arg1)
-                if isinstance(val, EvalStopFlow):
+        val = None
+        if hasattr(loop_iter, "__aiter__"):
+            #
+            # async iterators, like event and state streams, wait for
+            # each item
+            #
+            loop_iter = loop_iter.__aiter__()
+            while 1:
+                try:
+                    i = await loop_iter.__anext__()
+                except StopAsyncIteration:
                     break
-            if isinstance(val, EvalBreak):
-                break
-            if isinstance(val, EvalContinue):
-                continue
-            if isinstance(val, EvalReturn):
-                return val
+                val = await self.ast_for_body(arg, loop_var, i)
+                if isinstance(val, (EvalBreak, EvalReturn)):
+                    break
+        else:
+            for i in loop_iter:
+                val = await self.ast_for_body(arg, loop_var, i)
+                if isinstance(val, (EvalBreak, EvalReturn)):
+                    break
+        if isinstance(val, EvalReturn):
+            return val
         if not isinstance(val, EvalBreak):
             for arg1 in arg.orelse:
                 val = await self.aeval(arg1)
@@ -370,6 +416,15 @@ class AstEval:
                     return val
         return None
 
+    async def ast_for_body(self, arg, loop_var, i):
+        """Execute one iteration of a for statement body."""
+        self.sym_table[loop_var] = i
+        for arg1 in arg.body:
+            val = await self.aeval(arg1)
+            if isinstance(val, EvalStopFlow):
+                return val
+        return None
+
     async def ast_while(self, arg):
         """Execute while statement."""
         while 1:
@@ -582,6 +637,8 @@ class AstEval:
             #
             if arg.id in self.sym_table:
                 return self.sym_table[arg.id]
+            if self.notify_vars is not None and arg.id in self.notify_vars:
+                return self.notify_vars[arg.id]
             if arg.id in self.local_sym_table:
                 return self.local_sym_table[arg.id]
             if arg.id in self.global_sym_table:
@@ -902,6 +959,168 @@ class AstEval:
             self.ast_get_names2_dict(self.ast, names)
         return [*names]
 
+    def is_state_name(self, name):
+        """Return whether a dotted name refers to a state variable, rather than a symbol or function."""
+        parts = name.split(".")
+        if len(parts) != 2 and len(parts) != 3:
+            return False
+        for sym_table in [self.sym_table, self.global_sym_table]:
+            if parts[0] in sym_table or name in sym_table:
+                return False
+        if (
+            name in BUILTIN_FUNCS
+            or name in self.handler.ast_functions
+            or self.handler.get(name)
+        ):
+            return False
+        return True
+
+    def ast_get_state_names2_dict(self, arg, names):
+        """Recursively find the state variable names mentioned in the AST tree."""
+        if isinstance(arg, ast.Attribute):
+            name = self.ast_attribute2_name(arg)
+            if name is None:
+                self.ast_get_state_names2_dict(arg.value, names)
+            elif self.is_state_name(name):
+                names[name] = 1
+        elif not isinstance(arg, ast.Name):
+            if (
+                isinstance(arg, ast.Call)
+                and isinstance(arg.func, ast.Attribute)
+                and len(arg.args) > 0
+                and self.ast_attribute2_name(arg.func)
+                in self.handler.state_arg_functions
+            ):
+                #
+                # functions like window.avg("sensor.x", "5min") depend on
+                # the state variable named by a constant first argument
+                #
+                try:
+                    name = ast.literal_eval(arg.args[0])
+                except ValueError:
+                    name = None
+                if isinstance(name, str) and self.is_state_name(name):
+                    names[name] = 1
+            #
+            # plain names can't be state variables, so skip those
+            #
+            for child in ast.iter_child_nodes(arg):
+                self.ast_get_state_names2_dict(child, names)
+
+    def ast_get_state_names(self, arg=None):
+        """Return list of the state variable names mentioned in our AST tree, or the given node.
+
+        Unlike ast_get_names(), this skips builtins, pyscript and service
+        functions and anything in our symbol tables (eg, log.info or
+        module attributes), so only genuine state variables are returned.
+        """
+        names = {}
+        if arg is None:
+            arg = self.ast
+        if arg:
+            self.ast_get_state_names2_dict(arg, names)
+        return [*names]
+
+    def ast_state_only2(self, arg):
+        """Recursively check whether the AST tree only depends on state variables."""
+        if isinstance(arg, ast.Attribute):
+            name = self.ast_attribute2_name(arg)
+            if name is None:
+                return False
+            return self.is_state_name(name) or (
+                name in BUILTIN_FUNCS
+                and arg.value.id not in self.sym_table
+                and arg.value.id not in self.global_sym_table
+            )
+        if isinstance(arg, ast.Name):
+            return (
+                arg.id in BUILTIN_FUNCS
+                and arg.id not in self.sym_table
+                and arg.id not in self.global_sym_table
+            )
+        if isinstance(arg, ast.Call) and not isinstance(
+            arg.func, (ast.Name, ast.Attribute)
+        ):
+            return False
+        for child in ast.iter_child_nodes(arg):
+            if not self.ast_state_only2(child):
+                return False
+        return True
+
+    def ast_state_only(self):
+        """Return whether our expression only depends on state variables.
+
+        That means every name is a state variable or a builtin function, so
+        the value only changes when one of the state variables changes.
+        """
+        if (
+            not self.ast
+            or len(self.ast.body) != 1
+            or not isinstance(self.ast.body[0], ast.Expr)
+        ):
+            return False
+        return self.ast_state_only2(self.ast.body[0])
+
+    def ast_get_index_conds(self):
+        """Return dict of name: values conditions that must hold for our expression to be true.
+
+        Only top-level "and" terms of the form name == constant or name in
+        (constants) are recognized, and only for plain names that aren't
+        symbols, builtins or functions, ie, names that come from the event
+        data.  Event uses these to index triggers by event data value.
+        """
+        conds = {}
+        if not self.ast or len(self.ast.body) != 1:
+            return conds
+        expr = self.ast.body[0]
+        if not isinstance(expr, ast.Expr):
+            return conds
+        terms = [expr.value]
+        if isinstance(expr.value, ast.BoolOp) and isinstance(expr.value.op, ast.And):
+            terms = expr.value.values
+        for term in terms:
+            if (
+                not isinstance(term, ast.Compare)
+                or len(term.ops) != 1
+                or len(term.comparators) != 1
+            ):
+                continue
+            left, right = term.left, term.comparators[0]
+            if isinstance(term.ops[0], ast.Eq):
+                if not isinstance(left, ast.Name):
+                    left, right = right, left
+                try:
+                    values = [ast.literal_eval(right)]
+                except ValueError:
+                    continue
+            elif isinstance(term.ops[0], ast.In):
+                if not isinstance(right, (ast.Tuple, ast.List, ast.Set)):
+                    continue
+                try:
+                    values = list(ast.literal_eval(right))
+                except ValueError:
+                    continue
+            else:
+                continue
+            if not isinstance(left, ast.Name) or left.id in conds:
+                continue
+            name = left.id
+            if (
+                name in self.sym_table
+                or name in self.global_sym_table
+                or name in BUILTIN_FUNCS
+                or name in self.handler.ast_functions
+            ):
+                continue
+            try:
+                conds[name] = set(values)
+            except TypeError:
+                #
+                # unhashable constants can't be indexed
+                #
+                continue
+        return conds
+
     def parse(self, code_str, filename="<unknown>"):
         """Parse the code_str source code into an AST tree."""
         self.ast = None
@@ -946,7 +1165,7 @@ class AstEval:
         self.exception = None
         self.exception_long = None
         if new_state_vars:
-            self.local_sym_table.update(new_state_vars)
+            self.notify_vars = new_state_vars
         if self.ast:
             val = await self.aeval(self.ast)
             if isinstance(val, EvalStopFlow):
@@ -1,6 +1,11 @@
 """Handles event firing and notification."""
 
+import asyncio
+from collections import ChainMap
 import logging
+from types import MappingProxyType
+
+from homeassistant.components.pyscript.handler import STREAM_MAXLEN, NotifyStream
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -8,45 +13,101 @@ _LOGGER = logging.getLogger(__name__)
 class Event:
     """Defined event functions."""
 
-    def __init__(self, hass):
+    def __init__(self, hass, handler_func=None):
         """Initialize Event."""
 
         self.hass = hass
+        self.handler = handler_func
         #
-        # notify message queues by event type
+        # notify message queues (from task.wait_until) and triggers by event type
         #
         self.notify = {}
         self.notify_remove = {}
+        #
+        # queues and triggers whose condition requires an event data key to
+        # have one of a set of values are instead indexed here by
+        # event type, key and value, so they are only notified on a match
+        #
+        self.notify_index = {}
+        self.notify_index_conds = {}
+
+    def register_functions(self):
+        """Register event functions."""
+        functions = {
+            "event.stream": self.stream,
+        }
+        self.handler.register(functions)
+
+    def stream(self, event_type, maxlen=STREAM_MAXLEN):
+        """Implement event.stream(); return a persistent stream of events of the given type."""
+
+        def close_func():
+            self.notify_del(event_type, stream)
+
+        stream = NotifyStream(self.handler, maxlen, close_func)
+        self.notify_add(event_type, stream)
+        return stream
 
     async def event_listener(self, event):
         """Listen callback for given event which updates any notifications."""
 
         _LOGGER.debug("event_listener(%s)", event)
-        func_args = {
-            "trigger_type": "event",
-            "event_type": event.event_type,
-        }
-        func_args.update(event.data)
+        #
+        # func_args is a read-only view of the event data, shared by every
+        # subscriber, rather than a copy; those that hand it to a script
+        # make their own copy
+        #
+        func_args = MappingProxyType(
+            ChainMap(
+                event.data, {"trigger_type": "event", "event_type": event.event_type}
+            )
+        )
         await self.update(event.event_type, func_args)
 
-    def notify_add(self, event_type, queue):
-        """Register to notify for events of given type to be sent to queue."""
+    def notify_add(self, event_type, queue, data_conds=None):
+        """Register to notify for events of given type to be sent to queue.
+
+        data_conds is an optional dict of event data key: set of values, one
+        of which must match for the notification to be relevant.  The queue
+        is then indexed by the first key, so only candidate queues are
+        notified when an event arrives.
+        """
 
-        if event_type not in self.notify:
-            self.notify[event_type] = set()
+        if event_type not in self.notify_remove:
             _LOGGER.debug("event.notify_add(%s) -> adding event listener", event_type)
             self.notify_remove[event_type] = self.hass.bus.async_listen(
                 event_type, self.event_listener
             )
-        self.notify[event_type].add(queue)
+        if data_conds:
+            key = next(iter(data_conds))
+            index = self.notify_index.setdefault(event_type, {}).setdefault(key, {})
+            for value in data_conds[key]:
+                index.setdefault(value, set()).add(queue)
+            self.notify_index_conds[(event_type, queue)] = (key, data_conds[key])
+        else:
+            self.notify.setdefault(event_type, set()).add(queue)
 
     def notify_del(self, event_type, queue):
         """Unregister to notify for events of given type for given queue."""
 
-        if event_type not in self.notify or queue not in self.notify[event_type]:
+        if (event_type, queue) in self.notify_index_conds:
+            key, values = self.notify_index_conds.pop((event_type, queue))
+            index = self.notify_index[event_type][key]
+            for value in values:
+                index[value].discard(queue)
+                if len(index[value]) == 0:
+                    del index[value]
+            if len(index) == 0:
+                del self.notify_index[event_type][key]
+            if len(self.notify_index[event_type]) == 0:
+                del self.notify_index[event_type]
+        elif event_type in self.notify and queue in self.notify[event_type]:
+            self.notify[event_type].discard(queue)
+            if len(self.notify[event_type]) == 0:
+                del self.notify[event_type]
+        else:
             return
-        self.notify[event_type].discard(queue)
-        if len(self.notify[event_type]) == 0:
+        if event_type not in self.notify and event_type not in self.notify_index:
             self.notify_remove[event_type]()
             _LOGGER.debug("event.notify_del(%s) -> removing event listener", event_type)
             del self.notify_remove[event_type]
@@ -54,7 +115,20 @@ class Event:
     async def update(self, event_type, func_args):
         """Deliver all notifications for an event of the given type."""
 
-        _LOGGER.debug("event.update(%s, %s, %s)", event_type, vars, func_args)
-        if event_type in self.notify:
-            for queue in self.notify[event_type]:
+        _LOGGER.debug("event.update(%s, %s)", event_type, func_args)
+        queues = list(self.notify.get(event_type, []))
+        for key, index in self.notify_index.get(event_type, {}).items():
+            if key not in func_args:
+                continue
+            try:
+                queues.extend(index.get(func_args[key], []))
+            except TypeError:
+                #
+                # unhashable event data values can't match a constant
+                #
+                continue
+        for queue in queues:
+            if isinstance(queue, asyncio.Queue):
                 await queue.put(["event", func_args])
+            else:
+                await queue.notify_event(func_args)
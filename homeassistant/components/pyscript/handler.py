@@ -1,11 +1,35 @@
 """Function call handling."""
 
 import asyncio
+from collections import deque
+import heapq
 import logging
+import time
 import traceback
 
 _LOGGER = logging.getLogger(__name__)
 
+#
+# default number of low priority functions that can run at the same time
+#
+LOW_PRIORITY_MAX = 4
+
+#
+# order in which functions that are ready at the same time start, by
+# @task_priority
+#
+TASK_PRIORITY_ORDER = {"high": 0, "normal": 1, "low": 2}
+
+#
+# how often we check the event loop lag, in seconds, when load shedding is on
+#
+LAG_CHECK_INTERVAL = 0.5
+
+#
+# default ring buffer length of event.stream() and state.stream()
+#
+STREAM_MAXLEN = 100
+
 
 def current_task():
     """Return our asyncio current task."""
@@ -17,26 +41,248 @@ def current_task():
         return asyncio.tasks.Task.current_task()
 
 
+class NotifyQueue(asyncio.Queue):
+    """Notification queue for task.wait_until that can be bounded.
+
+    With max_len > 0, a new state notification for a variable that already
+    has one pending replaces it (so only the latest value is kept), and if
+    the queue is full the oldest notification is dropped.  Put never blocks.
+    With max_len == 0 it behaves like an unbounded asyncio.Queue, except
+    that state notifications are still coalesced while the event loop is
+    lagging (see Handler.lagging).
+    """
+
+    def __init__(self, handler_func, max_len=0):
+        """Initialize NotifyQueue."""
+        super().__init__(0)
+        self.handler = handler_func
+        self.max_len = max_len
+        self.pending_state = {}
+
+    def _put(self, item):
+        if (self.max_len > 0 or self.handler.lagging()) and (
+            item[0] == "state" and item[1]
+        ):
+            var_name = item[1][1].get("var_name", None)
+            pending = self.pending_state.get(var_name, None)
+            if pending is not None:
+                pending[1] = item[1]
+                self.handler.stats["notify_coalesced"] += 1
+                return
+            self.pending_state[var_name] = item
+        if self.max_len > 0 and len(self._queue) >= self.max_len:
+            self.drop(self._queue.popleft())
+            self.handler.stats["notify_dropped"] += 1
+        self._queue.append(item)
+
+    def _get(self):
+        item = self._queue.popleft()
+        self.drop(item)
+        return item
+
+    def drop(self, item):
+        """Forget an item that is leaving the queue."""
+        if item[0] == "state" and item[1]:
+            var_name = item[1][1].get("var_name", None)
+            if self.pending_state.get(var_name, None) is item:
+                del self.pending_state[var_name]
+
+
+class NotifyStream:
+    """Persistent stream of event or state notifications that a script iterates over.
+
+    The stream stays subscribed until close() is called, or the task that
+    created it exits (eg, because it was cancelled by task.unique or a
+    reload), so nothing is missed between iterations.  Notifications are
+    kept in a ring buffer of maxlen
+    entries, and the oldest are dropped if the script falls behind.  A for
+    loop over the stream waits for each notification, and ends once the
+    stream is closed and the buffer is empty.
+    """
+
+    def __init__(self, handler_func, maxlen, close_func):
+        """Initialize NotifyStream."""
+        if not isinstance(maxlen, int) or maxlen < 1:
+            raise ValueError("stream maxlen must be a positive integer")
+        self.handler = handler_func
+        self.buffer = deque(maxlen=maxlen)
+        self.close_func = close_func
+        self.closed = False
+        self.ready = asyncio.Event()
+        self.dropped = 0
+        try:
+            task = current_task()
+        except RuntimeError:
+            task = None
+        if task is not None:
+            task.add_done_callback(self.task_done)
+
+    def task_done(self, task):
+        """Close the stream once the task that created it is done."""
+        self.close()
+
+    def put(self, item):
+        """Add a notification to the buffer, dropping the oldest if it's full.
+
+        The item may be shared with other subscribers, so it's only copied
+        when the script reads it.
+        """
+        if len(self.buffer) == self.buffer.maxlen:
+            self.dropped += 1
+            self.handler.stats["stream_dropped"] += 1
+        self.buffer.append(item)
+        self.ready.set()
+
+    async def notify_event(self, func_args):
+        """Receive an event notification."""
+        self.put(func_args)
+
+    async def notify_state(self, new_vars, func_args):
+        """Receive a state change notification."""
+        self.put(func_args)
+
+    def __len__(self):
+        """Return the number of buffered notifications."""
+        return len(self.buffer)
+
+    def __aiter__(self):
+        """Return our async iterator."""
+        return self
+
+    async def __anext__(self):
+        """Wait for and return the next notification."""
+        while len(self.buffer) == 0:
+            if self.closed:
+                raise StopAsyncIteration
+            self.ready.clear()
+            await self.ready.wait()
+        return dict(self.buffer.popleft())
+
+    async def drain(self, max_items=None, max_wait=None):
+        """Implement stream.drain(); wait for notifications and return them as a list.
+
+        This waits until at least one notification is buffered, and then,
+        if max_wait is given, up to max_wait more seconds for max_items to
+        accumulate.  Up to max_items (or all if None) are returned, so one
+        call can process a batch.  An empty list means the stream is closed.
+        """
+        if max_items is not None and (not isinstance(max_items, int) or max_items < 1):
+            raise ValueError("drain max_items must be a positive integer")
+        while len(self.buffer) == 0:
+            if self.closed:
+                return []
+            self.ready.clear()
+            await self.ready.wait()
+        if max_wait is not None:
+            time_end = time.monotonic() + max_wait
+            while not self.closed and (
+                max_items is None or len(self.buffer) < max_items
+            ):
+                time_left = time_end - time.monotonic()
+                if time_left <= 0:
+                    break
+                self.ready.clear()
+                try:
+                    await asyncio.wait_for(self.ready.wait(), timeout=time_left)
+                except asyncio.TimeoutError:
+                    break
+        count = len(self.buffer)
+        if max_items is not None and max_items < count:
+            count = max_items
+        return [dict(self.buffer.popleft()) for _ in range(count)]
+
+    def close(self):
+        """Unsubscribe the stream; any buffered notifications can still be read."""
+        if self.closed:
+            return
+        self.closed = True
+        self.close_func()
+        self.ready.set()
+
+
 class Handler:
     """Define function handler functions."""
 
-    def __init__(self, hass):
+    def __init__(
+        self, hass, notify_queue_max=0, low_priority_max=LOW_PRIORITY_MAX, lag_max=0
+    ):
         """Initialize State."""
         self.hass = hass
         self.unique_task2name = {}
         self.unique_name2task = {}
 
+        #
+        # task priorities of functions set with @task_priority, indexed by
+        # function name.  Low priority functions wait for one of
+        # low_priority_max slots before they run.
+        #
+        self.task_priorities = {}
+        self.low_priority_max = low_priority_max
+        self.low_priority_lane = None
+
+        #
+        # While any function has a priority, tasks wait in this heap of
+        # [order, seq, future] before they start, and start_release()
+        # starts all the ones that are waiting, highest priority first.
+        # start_handle is the pending loop callback for start_release().
+        #
+        self.start_queue = []
+        self.start_seq = 0
+        self.start_handle = None
+
+        #
+        # maximum length of task.wait_until notification queues, and
+        # counters of notifications that were coalesced or dropped
+        #
+        self.notify_queue_max = notify_queue_max
+        self.stats = {
+            "notify_coalesced": 0,
+            "notify_dropped": 0,
+            "action_dropped": 0,
+            "action_cancelled": 0,
+            "action_low_priority_waited": 0,
+            "lag_detected": 0,
+            "lag_skipped": 0,
+            "lag_deferred": 0,
+            "stream_dropped": 0,
+            "state_set_suppressed": 0,
+            "state_set_coalesced": 0,
+        }
+
+        #
+        # load shedding: when lag_max > 0 we periodically measure how late
+        # the event loop runs a timer, and while that exceeds lag_max we
+        # shed or defer work that can tolerate it
+        #
+        self.lag_max = lag_max
+        self.lag_timer = None
+        self.lag_check_due = None
+        self.loop_lag = 0
+
+        #
+        # task modes of functions set with @task_mode, indexed by function
+        # name, together with their running tasks and queued coroutines
+        #
+        self.task_modes = {}
+
         #
         # initial list of available functions
         #
         self.functions = {
             "event.fire": self.event_fire,
             "task.sleep": self.async_sleep,
+            "task.stats": self.task_stats,
             "task.unique": self.task_unique,
             "service.call": self.service_call,
             "service.has_service": self.service_has_service,
         }
 
+        #
+        # functions whose first argument is the name of a state variable
+        # they depend on, eg window.avg("sensor.power", "5min")
+        #
+        self.state_arg_functions = set()
+
         #
         # Functions that take the AstEval context as a first argument,
         # which is needed by a handful of special functions that need the
@@ -61,6 +307,43 @@ class Handler:
         """Implement task.sleep()."""
         await asyncio.sleep(float(duration))
 
+    def task_stats(self):
+        """Implement task.stats()."""
+        stats = self.stats.copy()
+        stats["loop_lag"] = self.loop_lag
+        return stats
+
+    def lag_monitor_start(self):
+        """Start checking the event loop lag, if load shedding is configured."""
+        if self.lag_max <= 0 or self.lag_timer is not None:
+            return
+        self.lag_check_due = self.hass.loop.time() + LAG_CHECK_INTERVAL
+        self.lag_timer = self.hass.loop.call_at(self.lag_check_due, self.lag_check)
+
+    def lag_monitor_stop(self):
+        """Stop checking the event loop lag."""
+        if self.lag_timer is not None:
+            self.lag_timer.cancel()
+            self.lag_timer = None
+        self.loop_lag = 0
+
+    def lag_check(self):
+        """Measure how late our lag timer ran, and schedule the next check."""
+        self.lag_timer = None
+        self.loop_lag = max(0, self.hass.loop.time() - self.lag_check_due)
+        if self.lagging():
+            _LOGGER.debug("event loop lag %.3f sec; shedding load", self.loop_lag)
+            self.stats["lag_detected"] += 1
+        self.lag_monitor_start()
+
+    def lagging(self):
+        """Return True if the event loop lag exceeds lag_max and we should shed load."""
+        return self.lag_max > 0 and self.loop_lag > self.lag_max
+
+    def notify_queue(self):
+        """Return a new notification queue, bounded if so configured."""
+        return NotifyQueue(self, self.notify_queue_max)
+
     async def event_fire(self, event_type, **kwargs):
         """Implement event.fire()."""
         self.hass.bus.async_fire(event_type, kwargs)
@@ -120,10 +403,16 @@ class Handler:
         """Implement log.warning()."""
         return self.get_logger(ast_ctx, "warning", *arg, **kw)
 
-    def register(self, funcs):
-        """Register functions to be available for calling."""
+    def register(self, funcs, state_arg=False):
+        """Register functions to be available for calling.
+
+        If state_arg is set, the functions take a state variable name as their
+        first argument, which triggers will then watch.
+        """
         for name, func in funcs.items():
             self.functions[name] = func
+            if state_arg:
+                self.state_arg_functions.add(name)
 
     def register_ast(self, funcs):
         """Register functions that need ast context to be available for calling."""
@@ -155,15 +444,29 @@ class Handler:
 
         return service_call
 
-    async def run_coro(self, coro):
+    async def run_coro(self, coro, name=None):
         """Run coroutine task and update unique task on start and exit."""
         try:
-            await coro
+            if len(self.task_priorities) > 0:
+                priority = self.task_priorities.get(name, "normal")
+                await self.start_wait(priority)
+                if priority == "low":
+                    await self.run_low_priority(coro)
+                else:
+                    await coro
+            else:
+                await coro
         except asyncio.CancelledError:
+            #
+            # avoid a warning if we were cancelled before coro started
+            #
+            coro.close()
             task = current_task()
             if task in self.unique_task2name:
                 self.unique_name2task.pop(self.unique_task2name[task], None)
                 self.unique_task2name.pop(task, None)
+            if name is not None:
+                self.task_mode_done(name, task)
             raise
         except Exception:  # pylint: disable=broad-except
             _LOGGER.error("run_coro: %s", traceback.format_exc(-1))
@@ -171,7 +474,112 @@ class Handler:
         if task in self.unique_task2name:
             self.unique_name2task.pop(self.unique_task2name[task], None)
             self.unique_task2name.pop(task, None)
+        if name is not None:
+            self.task_mode_done(name, task)
+
+    async def start_wait(self, priority):
+        """Wait until the tasks created at the same time as us with higher priority have started."""
+        future = self.hass.loop.create_future()
+        heapq.heappush(
+            self.start_queue, [TASK_PRIORITY_ORDER[priority], self.start_seq, future]
+        )
+        self.start_seq += 1
+        if self.start_handle is None:
+            self.start_handle = self.hass.loop.call_soon(self.start_release)
+        await future
 
-    def create_task(self, coro):
-        """Create a new task that runs a coroutine."""
-        return self.hass.loop.create_task(self.run_coro(coro))
+    def start_release(self):
+        """Start the waiting tasks in priority order."""
+        self.start_handle = None
+        while len(self.start_queue) > 0:
+            future = heapq.heappop(self.start_queue)[2]
+            #
+            # tasks resume in the order their futures are done; a
+            # cancelled task's future is already done
+            #
+            if not future.done():
+                future.set_result(None)
+
+    async def run_low_priority(self, coro):
+        """Run a low priority coroutine once one of the low priority slots is free."""
+        if self.low_priority_lane is None:
+            self.low_priority_lane = asyncio.Semaphore(self.low_priority_max)
+        if self.low_priority_lane.locked():
+            self.stats["action_low_priority_waited"] += 1
+        async with self.low_priority_lane:
+            await coro
+
+    def task_priority_set(self, name, priority=None):
+        """Set the task priority of the function name, or remove it if priority is None."""
+        if priority is None or priority == "normal":
+            self.task_priorities.pop(name, None)
+        else:
+            self.task_priorities[name] = priority
+
+    def task_mode_set(self, name, mode=None, max_tasks=None):
+        """Set the task mode of the function name, or remove it if mode is None."""
+        info = self.task_modes.get(name, None)
+        if mode is None:
+            if info is not None:
+                info["mode"] = None
+                if len(info["running"]) == 0:
+                    del self.task_modes[name]
+            return
+        if info is None:
+            info = self.task_modes[name] = {"running": set(), "queue": deque()}
+        info["mode"] = mode
+        info["max"] = max_tasks
+
+    def task_mode_done(self, name, task):
+        """Update the task mode bookkeeping when a task of function name finishes."""
+        info = self.task_modes.get(name, None)
+        if info is None:
+            return
+        info["running"].discard(task)
+        if len(info["queue"]) > 0 and len(info["running"]) == 0:
+            self.task_mode_start(name, info["queue"].popleft())
+        elif info["mode"] is None and len(info["running"]) == 0:
+            del self.task_modes[name]
+
+    def task_mode_start(self, name, coro):
+        """Start a task of function name, recording it as running."""
+        task = self.hass.loop.create_task(self.run_coro(coro, name))
+        self.task_modes[name]["running"].add(task)
+        return task
+
+    def create_task(self, coro, name=None):
+        """Create a new task that runs a coroutine.
+
+        If name is a function with a task mode (see @task_mode), the mode
+        decides whether the coroutine runs now, is queued or is dropped (in
+        which case None is returned), or whether the running tasks are
+        cancelled first.  If any function has a priority (see
+        @task_priority), tasks created at the same time start in priority
+        order, and low priority ones wait for a low priority slot.
+        """
+        info = self.task_modes.get(name, None) if name is not None else None
+        if info is None or info["mode"] is None:
+            return self.hass.loop.create_task(self.run_coro(coro, name))
+        running = info["running"]
+        mode = info["mode"]
+        if mode == "restart":
+            for task in running:
+                task.cancel()
+                self.stats["action_cancelled"] += 1
+        elif mode == "queued":
+            if len(running) > 0 or len(info["queue"]) > 0:
+                if len(info["queue"]) < info["max"]:
+                    info["queue"].append(coro)
+                    return None
+                mode = "drop"
+        elif mode == "single":
+            if len(running) > 0:
+                mode = "drop"
+        elif len(running) >= info["max"]:
+            mode = "drop"
+        if mode == "drop":
+            _LOGGER.debug("%s is running; %s mode drops new call", name, info["mode"])
+            self.stats["action_dropped"] += 1
+            coro.close()
+            return None
+        return self.task_mode_start(name, coro)
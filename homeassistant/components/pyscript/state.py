@@ -1,23 +1,169 @@
 """Handles state variable access and change notification."""
 
+import array
+import asyncio
+import bisect
+from collections import ChainMap
+import io
 import logging
+import re
+import time
+import tokenize
+
+from homeassistant.components.pyscript.eval import BUILTIN_FUNCS, AstEval
+from homeassistant.components.pyscript.handler import STREAM_MAXLEN, NotifyStream
+from homeassistant.components.pyscript.trigger import parse_time_offset
+from homeassistant.const import EVENT_STATE_CHANGED
+from homeassistant.core import callback, valid_entity_id, valid_state
+from homeassistant.exceptions import InvalidEntityFormatError, InvalidStateError
 
 _LOGGER = logging.getLogger(__name__)
 
+#
+# A wildcard state variable in a trigger, eg binary_sensor.door_* or light.*,
+# isn't valid python, so it's rewritten to a name with this suffix instead,
+# eg binary_sensor.door___glob__ or light.__glob__
+#
+GLOB_SUFFIX = "__glob__"
+
+GLOB_RE = re.compile(
+    r"(?<![\w.])([A-Za-z_]\w*\.\w*)\*"
+    r"(?=\.[A-Za-z_]|\s*(?:[=!<>)\],:]|(?:in|not|and|or|is|if|else)\b|$))"
+)
+
+
+#
+# State values that state.getf() returns as a bool
+#
+STATE_BOOL_VALUES = {"on": True, "off": False, "true": True, "false": False}
+
+#
+# Maximum number of samples we keep in each state variable window
+#
+WINDOW_SAMPLES_MAX = 10000
+
+
+class StateWindow:
+    """Time-stamped numeric samples of a state variable, for rolling-window functions.
+
+    Samples are appended to a pair of arrays, and samples older than the
+    longest period anyone has asked for are discarded from the front, so
+    each update is amortized O(1).  The newest sample older than that is
+    kept, since it's the value in effect at the start of the window.
+    """
+
+    def __init__(self):
+        """Initialize StateWindow."""
+        self.times = array.array("d")
+        self.values = array.array("d")
+        self.start = 0
+        self.period = 0
+
+    def add(self, time_now, value):
+        """Add a sample, and discard any we no longer need."""
+        self.times.append(time_now)
+        self.values.append(value)
+        time_expire = time_now - self.period
+        while (
+            self.start + 1 < len(self.times)
+            and self.times[self.start + 1] <= time_expire
+        ):
+            self.start += 1
+        if len(self.times) - self.start > WINDOW_SAMPLES_MAX:
+            self.start = len(self.times) - WINDOW_SAMPLES_MAX
+        if self.start > len(self.times) // 2:
+            del self.times[: self.start]
+            del self.values[: self.start]
+            self.start = 0
+
+    def samples(self, time_now, period, current=True):
+        """Return arrays of the sample times and values in the last period seconds.
+
+        With current set, if no sample is that recent, the latest one (ie,
+        the value in effect) is returned instead.
+        """
+        self.period = max(self.period, period)
+        idx = bisect.bisect_left(self.times, time_now - period, self.start)
+        if current and idx == len(self.times) and idx > self.start:
+            idx -= 1
+        return self.times[idx:], self.values[idx:]
+
+    def average(self, time_now, period):
+        """Return the time-weighted average value over the last period seconds, or None.
+
+        Each value is weighted by how long it was in effect during the
+        period, starting with the value in effect at the start.
+        """
+        self.period = max(self.period, period)
+        time_start = time_now - period
+        idx = bisect.bisect_right(self.times, time_start, self.start)
+        if idx > self.start:
+            idx -= 1
+        if idx == len(self.times):
+            return None
+        total = 0
+        duration = 0
+        for i in range(idx, len(self.times)):
+            time0 = max(self.times[i], time_start)
+            time1 = self.times[i + 1] if i + 1 < len(self.times) else time_now
+            if time1 > time0:
+                total += self.values[i] * (time1 - time0)
+                duration += time1 - time0
+        if duration == 0:
+            return self.values[-1]
+        return total / duration
+
 
 class State:
     """Class for state functions."""
 
-    def __init__(self, hass, handler_func):
+    def __init__(self, hass, handler_func, set_delay=0):
         """Initialize State."""
 
         self.hass = hass
         self.handler = handler_func
         #
-        # notify message queues by variable
+        # notify message queues (from task.wait_until) and triggers, indexed
+        # by state variable and then attribute name, eg:
+        #
+        #   self.notify["sensor.x"][None][queue] = var_names
+        #   self.notify["sensor.x"]["attr"][queue] = var_names
+        #
+        # where None means the state value itself.  That way we only notify
+        # when the state value or an attribute someone refers to changes.
         #
         self.notify = {}
 
+        #
+        # Wildcard state variables are kept in self.notify too, keyed by
+        # their pattern, eg "binary_sensor.door_*".  To find the patterns
+        # matching an entity without scanning them all, we also index the
+        # prefixes by domain, eg:
+        #
+        #   self.notify_glob["binary_sensor"] = {"door_"}
+        #
+        self.notify_glob = {}
+
+        #
+        # Version numbers of state variables and attributes that shared
+        # trigger expressions depend on, indexed like self.notify, together
+        # with reference counts:
+        #
+        #   self.version["sensor.x"][None] = [version, ref_count]
+        #   self.version["sensor.x"]["attr"] = [version, ref_count]
+        #
+        # The version is bumped whenever the state value or that attribute
+        # changes.
+        #
+        self.version = {}
+
+        #
+        # We only listen to state_changed events while something is in
+        # self.notify or self.version; this is the function to remove that
+        # listener.
+        #
+        self.notify_remove = None
+
         #
         # Last value of state variable notifications.  We maintain this
         # so that trigger evaluation can use the last notified value,
@@ -26,32 +172,330 @@ class State:
         #
         self.notify_var_last = {}
 
+        #
+        # Rolling windows of numeric values of state variables and
+        # attributes used by the window functions, indexed like
+        # self.notify.  A window is created the first time it's used,
+        # and updated on every change from then on:
+        #
+        #   self.windows["sensor.x"][None] = StateWindow()
+        #   self.windows["sensor.x"]["attr"] = StateWindow()
+        #
+        self.windows = {}
+
+        #
+        # Typed values of state variables and attributes read with
+        # state.getf(), keyed by (entity, attr), together with the HA state
+        # object they were parsed from.  HA replaces the state object on
+        # every change, so an entry is valid while its object is current:
+        #
+        #   self.parsed[("sensor.x", None)] = [state_obj, 21.5]
+        #
+        self.parsed = {}
+
+        #
+        # Index of the current HA state objects by domain, used by
+        # state.names() and state.query().  It's built from
+        # hass.states.async_all() the first time it's needed, and then
+        # kept up to date from state_changed events:
+        #
+        #   self.domains["light"]["light.kitchen"] = state_obj
+        #
+        self.domains = None
+
+        #
+        # Writes from state.set() that haven't been made in hass yet.  They
+        # are made set_delay seconds after the first one (or in the next
+        # event loop iteration if it's 0), so several writes to the same
+        # state variable in that time result in one state_changed event:
+        #
+        #   self.set_pending["sensor.x"] = [value, attributes]
+        #
+        # set_handle is the loop handle for making them.
+        #
+        self.set_pending = {}
+        self.set_delay = set_delay
+        self.set_handle = None
+
+        #
+        # the numpy module, if it's enabled in the configuration, which
+        # window.array() and the other window functions then use
+        #
+        self.numpy = None
+
+    @staticmethod
+    def glob_rewrite(code_str):
+        """Rewrite wildcard state variables like domain.prefix* into valid names.
+
+        Text inside string literals, eg "sensor.*", is left alone.
+        """
+        if isinstance(code_str, list):
+            return [State.glob_rewrite(line) for line in code_str]
+        #
+        # find the string literals' offsets; tokenize doesn't check the
+        # syntax, so the wildcards themselves are fine
+        #
+        line_start = [0]
+        for line in code_str.splitlines(True):
+            line_start.append(line_start[-1] + len(line))
+        strings = []
+        try:
+            for token in tokenize.generate_tokens(io.StringIO(code_str).readline):
+                if token.type == tokenize.STRING:
+                    strings.append(
+                        (
+                            line_start[token.start[0] - 1] + token.start[1],
+                            line_start[token.end[0] - 1] + token.end[1],
+                        )
+                    )
+        except (tokenize.TokenError, SyntaxError):
+            #
+            # eg, an unterminated string; parsing will report that later
+            #
+            pass
+        result = []
+        pos = 0
+        for match in GLOB_RE.finditer(code_str):
+            if any(start <= match.start() < end for start, end in strings):
+                continue
+            result.append(code_str[pos : match.end(1)])
+            result.append(GLOB_SUFFIX)
+            pos = match.end()
+        result.append(code_str[pos:])
+        return "".join(result)
+
+    @staticmethod
+    def is_glob(var_name):
+        """Return whether a state variable name is a rewritten wildcard."""
+        parts = var_name.split(".")
+        return len(parts) >= 2 and parts[1].endswith(GLOB_SUFFIX)
+
+    @staticmethod
+    def notify_key(var_name):
+        """Return the state variable and attribute name (or None) to notify on, or None."""
+        parts = var_name.split(".")
+        if len(parts) != 2 and len(parts) != 3:
+            return None
+        if parts[1].endswith(GLOB_SUFFIX):
+            parts[1] = parts[1][: -len(GLOB_SUFFIX)] + "*"
+        if len(parts) == 2:
+            return f"{parts[0]}.{parts[1]}", None
+        #
+        # the prior value domain.name.old changes with the state value
+        #
+        return f"{parts[0]}.{parts[1]}", (None if parts[2] == "old" else parts[2])
+
+    def notify_keys(self, entity_id):
+        """Return the self.notify keys matching an entity, including wildcards."""
+        keys = [entity_id] if entity_id in self.notify else []
+        domain, _, obj_id = entity_id.partition(".")
+        prefixes = self.notify_glob.get(domain)
+        if prefixes:
+            for i in range(len(obj_id) + 1):
+                if obj_id[:i] in prefixes:
+                    keys.append(f"{domain}.{obj_id[:i]}*")
+        return keys
+
     def notify_add(self, var_names, queue):
-        """Register to notify state variables changes to be sent to queue."""
+        """Register to notify state variables changes to be sent to queue or trigger."""
 
         for var_name in var_names if isinstance(var_names, list) else [var_names]:
-            parts = var_name.split(".")
-            if len(parts) != 2 and len(parts) != 3:
+            key = self.notify_key(var_name)
+            if key is None:
                 continue
-            state_var_name = f"{parts[0]}.{parts[1]}"
+            state_var_name, attr = key
             if state_var_name not in self.notify:
                 self.notify[state_var_name] = {}
-            self.notify[state_var_name][queue] = var_names
+                if state_var_name.endswith("*"):
+                    domain, prefix = state_var_name[:-1].split(".")
+                    self.notify_glob.setdefault(domain, set()).add(prefix)
+            if attr not in self.notify[state_var_name]:
+                self.notify[state_var_name][attr] = {}
+            self.notify[state_var_name][attr][queue] = var_names
+        self.notify_listen()
 
     def notify_del(self, var_names, queue):
         """Unregister notify of state variables changes for given queue."""
 
         for var_name in var_names if isinstance(var_names, list) else [var_names]:
-            parts = var_name.split(".")
-            if len(parts) != 2 and len(parts) != 3:
+            key = self.notify_key(var_name)
+            if key is None:
                 continue
-            state_var_name = f"{parts[0]}.{parts[1]}"
+            state_var_name, attr = key
             if (
                 state_var_name not in self.notify
-                or queue not in self.notify[state_var_name]
+                or attr not in self.notify[state_var_name]
+                or queue not in self.notify[state_var_name][attr]
             ):
-                return
-            del self.notify[state_var_name][queue]
+                continue
+            del self.notify[state_var_name][attr][queue]
+            if len(self.notify[state_var_name][attr]) == 0:
+                del self.notify[state_var_name][attr]
+                if len(self.notify[state_var_name]) == 0:
+                    del self.notify[state_var_name]
+                    if state_var_name.endswith("*"):
+                        domain, prefix = state_var_name[:-1].split(".")
+                        self.notify_glob[domain].discard(prefix)
+                        if len(self.notify_glob[domain]) == 0:
+                            del self.notify_glob[domain]
+        self.notify_listen()
+
+    def notify_listen(self):
+        """Add or remove our state_changed listener depending on whether it's needed."""
+        needed = (
+            len(self.notify) > 0
+            or len(self.version) > 0
+            or len(self.windows) > 0
+            or self.domains is not None
+        )
+        if self.notify_remove is None and needed:
+            _LOGGER.debug("state.notify_listen() -> adding state_changed listener")
+            self.notify_remove = self.hass.bus.async_listen(
+                EVENT_STATE_CHANGED, self.state_changed
+            )
+        elif self.notify_remove is not None and not needed:
+            _LOGGER.debug("state.notify_listen() -> removing state_changed listener")
+            self.notify_remove()
+            self.notify_remove = None
+
+    def version_add(self, var_names):
+        """Start tracking the version numbers of the given state variables."""
+        for var_name in var_names:
+            key = self.notify_key(var_name)
+            if key is None:
+                continue
+            entity, attr = key
+            version = self.version.setdefault(entity, {})
+            if attr in version:
+                version[attr][1] += 1
+            else:
+                version[attr] = [0, 1]
+        self.notify_listen()
+
+    def version_del(self, var_names):
+        """Stop tracking the version numbers of the given state variables."""
+        for var_name in var_names:
+            key = self.notify_key(var_name)
+            if key is None:
+                continue
+            entity, attr = key
+            if entity not in self.version or attr not in self.version[entity]:
+                continue
+            self.version[entity][attr][1] -= 1
+            if self.version[entity][attr][1] <= 0:
+                del self.version[entity][attr]
+                if len(self.version[entity]) == 0:
+                    del self.version[entity]
+        self.notify_listen()
+
+    def version_get(self, var_names):
+        """Return a tuple of the current version numbers of the given state variables.
+
+        None is returned if any of them isn't being tracked.
+        """
+        version = []
+        for var_name in var_names:
+            key = self.notify_key(var_name)
+            if key is None:
+                return None
+            entity, attr = key
+            if entity not in self.version or attr not in self.version[entity]:
+                return None
+            version.append(self.version[entity][attr][0])
+        return tuple(version)
+
+    def version_bump(self, entity, new_state=None, old_state=None):
+        """Bump the versions of a state variable and its attributes that changed.
+
+        Without the new and old states, all the versions are bumped.
+        """
+        if entity not in self.version:
+            return
+        new_val = new_state.state if new_state else None
+        old_val = old_state.state if old_state else None
+        new_attrs = new_state.attributes if new_state else {}
+        old_attrs = old_state.attributes if old_state else {}
+        for attr, version in self.version[entity].items():
+            if new_state is None or old_state is None:
+                version[0] += 1
+            elif attr is None:
+                if new_val != old_val:
+                    version[0] += 1
+            elif new_attrs.get(attr) != old_attrs.get(attr):
+                version[0] += 1
+
+    @callback
+    def state_changed(self, event):
+        """Listen callback for state_changed events, which ignores variables nobody watches.
+
+        This is a plain callback rather than a coroutine, so HA doesn't
+        have to create a task for the (large majority of) state changes
+        that nobody is interested in.
+        """
+        entity_id = event.data["entity_id"]
+        if self.domains is not None:
+            self.domains_update(entity_id, event.data["new_state"])
+        #
+        # bump the version straight away, so shared expressions used by
+        # state_active or wait_until don't return a cached value for the
+        # old state before state_changed_update runs
+        #
+        self.version_bump(entity_id, event.data["new_state"], event.data["old_state"])
+        if (
+            entity_id in self.notify
+            or entity_id in self.version
+            or entity_id in self.windows
+            or (self.notify_glob and self.notify_keys(entity_id))
+        ):
+            self.handler.create_task(self.state_changed_update(event))
+
+    async def state_changed_update(self, event):
+        """Update any notifications for a state_changed event."""
+
+        var_name = event.data["entity_id"]
+        #
+        # bump the version again right before delivering the notifications,
+        # since an expression evaluated since state_changed() could have
+        # cached a value using the previously notified values
+        #
+        new_state = event.data["new_state"]
+        old_state = event.data["old_state"]
+        self.version_bump(var_name, new_state, old_state)
+        self.window_update(var_name, new_state, old_state)
+        keys = self.notify_keys(var_name)
+        if len(keys) == 0:
+            return
+        new_val = new_state.state if new_state else None
+        old_val = old_state.state if old_state else None
+        new_attrs = new_state.attributes if new_state else {}
+        old_attrs = old_state.attributes if old_state else {}
+        new_vars = {}
+        for key in keys:
+            #
+            # wildcard matches are delivered under their rewritten name
+            #
+            name = key[:-1] + GLOB_SUFFIX if key.endswith("*") else key
+            if new_val != old_val or new_state is None or old_state is None:
+                new_vars[name] = new_val
+                new_vars[f"{name}.old"] = old_val
+            #
+            # only compare the attributes that someone is watching
+            #
+            for attr in self.notify[key]:
+                if attr is None:
+                    continue
+                new_attr = new_attrs.get(attr)
+                if new_attr != old_attrs.get(attr):
+                    new_vars[f"{name}.{attr}"] = new_attr
+        if len(new_vars) == 0:
+            return
+        func_args = {
+            "trigger_type": "state",
+            "var_name": var_name,
+            "value": new_val,
+            "old_value": old_val,
+        }
+        await self.update(new_vars, func_args)
 
     async def update(self, new_vars, func_args):
         """Deliver all notifications for state variable changes."""
@@ -59,12 +503,23 @@ class State:
         _LOGGER.debug("state.update(%s, %s)", new_vars, func_args)
         notify = {}
         for var_name, var_val in new_vars.items():
-            if var_name in self.notify:
-                self.notify_var_last[var_name] = var_val
-                notify.update(self.notify[var_name])
+            key = self.notify_key(var_name)
+            if key is None or key[0] not in self.notify:
+                continue
+            self.notify_var_last[var_name] = var_val
+            state_var_name, attr = key
+            if attr in self.notify[state_var_name]:
+                notify.update(self.notify[state_var_name][attr])
 
         for queue, var_names in notify.items():
-            await queue.put(["state", [self.notify_var_get(var_names), func_args]])
+            if isinstance(queue, asyncio.Queue):
+                await queue.put(["state", [self.notify_var_get(var_names), func_args]])
+            else:
+                #
+                # triggers check their condition inline, and only
+                # create a task if their action runs
+                #
+                await queue.notify_state(self.notify_var_get(var_names), func_args)
 
     def notify_var_get(self, var_names):
         """Return the most recent value of a state variable change."""
@@ -81,14 +536,74 @@ class State:
                 "invalid variable name %s (should be 'domain.entity')", var_name
             )
             return
+        #
+        # hass stores the value as a string, so compare it that way
+        #
+        value = str(value)
+        #
+        # the write is made later in set_flush(), so check here what hass
+        # would reject, so the error is raised in the caller
+        #
+        if not valid_entity_id(var_name.lower()):
+            raise InvalidEntityFormatError(
+                f"Invalid entity id encountered: {var_name}. "
+                "Format should be <domain>.<object_id>"
+            )
+        if not valid_state(value):
+            raise InvalidStateError(
+                f"Invalid state encountered for entity id: {var_name}. "
+                "State max length is 255 characters."
+            )
+        attributes = dict(attributes) if attributes else {}
+        current = self.set_pending.get(var_name, None)
+        if current is None:
+            old_state = self.hass.states.get(var_name)
+            if old_state:
+                current = [old_state.state, old_state.attributes]
+        if current is not None and current[0] == value and current[1] == attributes:
+            self.handler.stats["state_set_suppressed"] += 1
+            return
         _LOGGER.debug("setting %s = %s, attr = %s", var_name, value, attributes)
-        self.hass.states.async_set(var_name, value, attributes)
+        if var_name in self.set_pending:
+            self.handler.stats["state_set_coalesced"] += 1
+        self.set_pending[var_name] = [value, attributes]
+        self.version_bump(var_name)
+        if self.set_handle is None:
+            if self.set_delay > 0:
+                self.set_handle = self.hass.loop.call_later(
+                    self.set_delay, self.set_flush
+                )
+            else:
+                self.set_handle = self.hass.loop.call_soon(self.set_flush)
+
+    @callback
+    def set_flush(self):
+        """Make the pending state.set() writes in hass."""
+        if self.set_handle is not None:
+            self.set_handle.cancel()
+            self.set_handle = None
+        pending, self.set_pending = self.set_pending, {}
+        for var_name, (value, attributes) in pending.items():
+            try:
+                self.hass.states.async_set(var_name, value, attributes)
+            except Exception as err:  # pylint: disable=broad-except
+                _LOGGER.error("state.set %s failed: %s", var_name, err)
+                continue
+            if self.domains is not None:
+                #
+                # our state_changed listener gets this a bit later, but
+                # state.names() and state.query() should see it straight away
+                #
+                self.domains_update(var_name, self.hass.states.get(var_name))
 
     def exist(self, var_name):
         """Check if a state variable value or attribute exists in hass."""
         parts = var_name.split(".")
         if len(parts) != 2 and len(parts) != 3:
             return False
+        pending = self.set_pending.get(f"{parts[0]}.{parts[1]}", None)
+        if pending is not None:
+            return len(parts) == 2 or pending[1].get(parts[2]) is not None
         value = self.hass.states.get(f"{parts[0]}.{parts[1]}")
         return value and (len(parts) == 2 or value.attributes.get(parts[2]) is not None)
 
@@ -97,6 +612,9 @@ class State:
         parts = var_name.split(".")
         if len(parts) != 2 and len(parts) != 3:
             return None
+        pending = self.set_pending.get(f"{parts[0]}.{parts[1]}", None)
+        if pending is not None:
+            return pending[0] if len(parts) == 2 else pending[1].get(parts[2])
         value = self.hass.states.get(f"{parts[0]}.{parts[1]}")
         if not value:
             return None
@@ -105,10 +623,341 @@ class State:
             return value.state
         return value.attributes.get(parts[2])
 
+    def stream(self, var_names, maxlen=STREAM_MAXLEN):
+        """Implement state.stream(); return a persistent stream of changes to the given state variables.
+
+        var_names is a state variable name or list of them, and can include
+        attributes and wildcards, eg "sensor.power", "light.*.brightness".
+        """
+        if isinstance(var_names, str):
+            var_names = [var_names]
+        var_names = [self.glob_rewrite(var_name) for var_name in var_names]
+
+        def close_func():
+            self.notify_del(var_names, stream)
+
+        stream = NotifyStream(self.handler, maxlen, close_func)
+        self.notify_add(var_names, stream)
+        return stream
+
+    @staticmethod
+    def window_value(value):
+        """Return a state value as a float for a window, or None if it isn't numeric."""
+        if isinstance(value, bool):
+            return None
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            return None
+
+    def window_update(self, entity, new_state, old_state):
+        """Add the new value of each window of entity that changed."""
+        if entity not in self.windows or new_state is None:
+            return
+        time_now = time.time()
+        for attr, window in self.windows[entity].items():
+            if attr is None:
+                new_val = new_state.state
+                old_val = old_state.state if old_state else None
+            else:
+                new_val = new_state.attributes.get(attr)
+                old_val = old_state.attributes.get(attr) if old_state else None
+            if new_val == old_val and old_state is not None:
+                continue
+            value = self.window_value(new_val)
+            if value is not None:
+                window.add(time_now, value)
+
+    def windows_clear(self):
+        """Discard all the windows, eg when the scripts that use them are reloaded.
+
+        Windows are created on first use by a script, so the reloaded
+        scripts start new ones for the state variables they still use.
+        """
+        self.windows = {}
+        self.notify_listen()
+
+    def window_get(self, var_name, period):
+        """Return the window of var_name, creating it if needed, the period in seconds, and the current time."""
+        parts = var_name.split(".")
+        if len(parts) != 2 and len(parts) != 3:
+            raise NameError(f"invalid state variable name '{var_name}'")
+        if isinstance(period, str):
+            period = parse_time_offset(period)
+        if not isinstance(period, (int, float)) or period <= 0:
+            raise ValueError(f"window period must be positive (got {period})")
+        entity = f"{parts[0]}.{parts[1]}"
+        attr = parts[2] if len(parts) == 3 else None
+        time_now = time.time()
+        window = self.windows.get(entity, {}).get(attr, None)
+        if window is None:
+            #
+            # start the window off with the current value
+            #
+            window = self.windows.setdefault(entity, {})[attr] = StateWindow()
+            value = self.hass.states.get(entity)
+            if value is not None:
+                number = self.window_value(
+                    value.state if attr is None else value.attributes.get(attr)
+                )
+                if number is not None:
+                    window.add(min(value.last_changed.timestamp(), time_now), number)
+            self.notify_listen()
+        return window, period, time_now
+
+    def window_samples(self, var_name, period, current=True):
+        """Return the sample times and values of var_name in the last period."""
+        window, period, time_now = self.window_get(var_name, period)
+        return window.samples(time_now, period, current)
+
+    def window_avg(self, var_name, period):
+        """Implement window.avg(); return the time-weighted average value over the last period, or None."""
+        window, period, time_now = self.window_get(var_name, period)
+        return window.average(time_now, period)
+
+    def window_min(self, var_name, period):
+        """Implement window.min(); return the minimum value over the last period, or None."""
+        _, values = self.window_samples(var_name, period)
+        return min(values) if len(values) > 0 else None
+
+    def window_max(self, var_name, period):
+        """Implement window.max(); return the maximum value over the last period, or None."""
+        _, values = self.window_samples(var_name, period)
+        return max(values) if len(values) > 0 else None
+
+    def window_count(self, var_name, period):
+        """Implement window.count(); return the number of changes in the last period."""
+        times, _ = self.window_samples(var_name, period, current=False)
+        return len(times)
+
+    def window_rate(self, var_name, period):
+        """Implement window.rate(); return the change per second over the last period, or None."""
+        times, values = self.window_samples(var_name, period, current=False)
+        if len(times) < 2 or times[-1] <= times[0]:
+            return None
+        return (values[-1] - values[0]) / (times[-1] - times[0])
+
+    def window_array(self, var_name, period):
+        """Implement window.array(); return the values over the last period as an array.
+
+        This is a numpy array if numpy is enabled, and otherwise an array.array.
+        """
+        _, values = self.window_samples(var_name, period)
+        if self.numpy is not None:
+            return self.numpy.array(values)
+        return values
+
+    def window_std(self, var_name, period):
+        """Implement window.std(); return the standard deviation over the last period, or None."""
+        _, values = self.window_samples(var_name, period)
+        if len(values) == 0:
+            return None
+        if self.numpy is not None:
+            return float(self.numpy.array(values).std())
+        mean = sum(values) / len(values)
+        return (sum((value - mean) ** 2 for value in values) / len(values)) ** 0.5
+
+    def window_slope(self, var_name, period):
+        """Implement window.slope(); return the least-squares slope per second over the last period, or None."""
+        times, values = self.window_samples(var_name, period, current=False)
+        if len(times) < 2 or times[-1] <= times[0]:
+            return None
+        if self.numpy is not None:
+            np_times = self.numpy.array(times)
+            return float(
+                self.numpy.polyfit(np_times - np_times[0], self.numpy.array(values), 1)[
+                    0
+                ]
+            )
+        time_mean = sum(times) / len(times)
+        value_mean = sum(values) / len(values)
+        cov = sum(
+            (sample_time - time_mean) * (value - value_mean)
+            for sample_time, value in zip(times, values)
+        )
+        var = sum((sample_time - time_mean) ** 2 for sample_time in times)
+        return cov / var
+
+    def window_ewma(self, var_name, period, alpha=0.5):
+        """Implement window.ewma(); return the exponentially smoothed value over the last period, or None.
+
+        Each sample, oldest first, is weighted by alpha and the smoothed
+        value so far by 1 - alpha.
+        """
+        if not isinstance(alpha, (int, float)) or not 0 < alpha <= 1:
+            raise ValueError(f"window.ewma alpha must be in (0, 1] (got {alpha})")
+        _, values = self.window_samples(var_name, period)
+        if len(values) == 0:
+            return None
+        smooth = values[0]
+        for value in values[1:]:
+            smooth += alpha * (value - smooth)
+        return smooth
+
+    @staticmethod
+    def typed_value(value):
+        """Return a state value as a bool, int or float if it can be parsed as one, or None."""
+        if isinstance(value, (bool, int, float)):
+            return value
+        if not isinstance(value, str):
+            return None
+        if value.lower() in STATE_BOOL_VALUES:
+            return STATE_BOOL_VALUES[value.lower()]
+        try:
+            return int(value)
+        except ValueError:
+            pass
+        try:
+            return float(value)
+        except ValueError:
+            return None
+
+    def getf(self, var_name, default=None):
+        """Implement state.getf(); return a state variable or attribute as a bool, int or float, or default.
+
+        "on", "off", "true" and "false" are bools, and other values are ints
+        or floats if they are numeric.
+
+        The parsed value is cached until the state variable changes, so
+        many triggers and functions can read the same sensor cheaply.
+        """
+        parts = var_name.split(".")
+        if len(parts) != 2 and len(parts) != 3:
+            raise NameError(f"invalid state variable name '{var_name}'")
+        entity = f"{parts[0]}.{parts[1]}"
+        attr = parts[2] if len(parts) == 3 else None
+        pending = self.set_pending.get(entity, None)
+        if pending is not None:
+            value = self.typed_value(
+                pending[0] if attr is None else pending[1].get(attr)
+            )
+            return default if value is None else value
+        value = self.hass.states.get(entity)
+        if value is None:
+            return default
+        parsed = self.parsed.get((entity, attr), None)
+        if parsed is None or parsed[0] is not value:
+            parsed = self.parsed[(entity, attr)] = [
+                value,
+                self.typed_value(
+                    value.state if attr is None else value.attributes.get(attr)
+                ),
+            ]
+        return default if parsed[1] is None else parsed[1]
+
+    def domains_index(self):
+        """Return the index of state objects by domain, building it on first use."""
+        if self.domains is None:
+            self.domains = {}
+            for value in self.hass.states.async_all():
+                self.domains.setdefault(value.domain, {})[value.entity_id] = value
+            self.notify_listen()
+        return self.domains
+
+    def domains_update(self, entity_id, new_state):
+        """Update the domain index with a changed state object, or None if it was removed."""
+        domain = entity_id.split(".", 1)[0]
+        if new_state is not None:
+            self.domains.setdefault(domain, {})[entity_id] = new_state
+        elif entity_id in self.domains.get(domain, {}):
+            del self.domains[domain][entity_id]
+            if len(self.domains[domain]) == 0:
+                del self.domains[domain]
+
+    def domains_items(self, domain=None):
+        """Return a dict of [value, attributes] of the state variables in domain, or all of them.
+
+        Pending state.set() writes are included, without making them.
+        """
+        domains = self.domains_index()
+        items = {}
+        for entities in (
+            domains.values() if domain is None else [domains.get(domain, {})]
+        ):
+            for entity_id, value in entities.items():
+                items[entity_id] = [value.state, value.attributes]
+        for entity_id, pending in self.set_pending.items():
+            if domain is None or entity_id.split(".", 1)[0] == domain:
+                items[entity_id] = pending
+        return items
+
+    def names(self, domain=None):
+        """Implement state.names(); return a sorted list of the state variables in a domain, or all of them."""
+        return sorted(self.domains_items(domain))
+
+    async def query(self, ast_ctx, domain=None, where=None):
+        """Implement state.query(); return a sorted list of state variables whose attributes match an expression.
+
+        where is evaluated for each state variable in domain (or all of
+        them) with its attributes, value and entity_id as variables.
+        Names that aren't defined in the caller's scope are taken to be
+        attributes, and state variables that lack any of them don't match.
+        Neither do state variables for which where raises an exception, eg
+        comparing an attribute that is None with a number.
+        """
+        items = self.domains_items(domain)
+        if where is None:
+            return sorted(items)
+        expr_ctx = AstEval(
+            f"{ast_ctx.name} state.query",
+            ast_ctx.global_sym_table,
+            state_func=self,
+            event_func=ast_ctx.event,
+            handler_func=self.handler,
+        )
+        expr_ctx.log_exceptions = False
+        self.handler.install_ast_funcs(expr_ctx)
+        if not expr_ctx.parse(where):
+            raise SyntaxError(f"state.query where: {expr_ctx.exception}")
+        attr_names = [
+            name
+            for name in expr_ctx.ast_get_names()
+            if "." not in name
+            and name not in {"value", "entity_id"}
+            and name not in ast_ctx.global_sym_table
+            and name not in BUILTIN_FUNCS
+            and not self.handler.get(name)
+        ]
+        names = []
+        for entity_id, (value, attributes) in items.items():
+            if any(name not in attributes for name in attr_names):
+                continue
+            expr_vars = ChainMap({"value": value, "entity_id": entity_id}, attributes)
+            if await expr_ctx.eval(expr_vars):
+                names.append(entity_id)
+            elif expr_ctx.exception is not None:
+                _LOGGER.debug("state.query %s: %s", entity_id, expr_ctx.exception)
+        return sorted(names)
+
     def register_functions(self):
         """Register state functions."""
         functions = {
             "state.get": self.get,
+            "state.names": self.names,
             "state.set": self.set,
+            "state.stream": self.stream,
         }
         self.handler.register(functions)
+        self.handler.register({"state.getf": self.getf}, state_arg=True)
+        window_functions = {
+            "window.array": self.window_array,
+            "window.avg": self.window_avg,
+            "window.count": self.window_count,
+            "window.ewma": self.window_ewma,
+            "window.max": self.window_max,
+            "window.min": self.window_min,
+            "window.rate": self.window_rate,
+            "window.slope": self.window_slope,
+            "window.std": self.window_std,
+        }
+        self.handler.register(window_functions, state_arg=True)
+
+        def query_factory(ast_ctx):
+            """Return a state.query function bound to the calling context."""
+
+            async def query_call(*arg, **kw):
+                return await self.query(ast_ctx, *arg, **kw)
+
+            return query_call
+
+        self.handler.register_ast({"state.query": query_factory})
@@ -1,5 +1,6 @@
 """Implements all the trigger logic."""
 
+import ast
 import asyncio
 import datetime
 import locale
@@ -7,14 +8,34 @@ import logging
 import math
 import re
 import time
+import traceback
+import weakref
 
 from homeassistant.components.pyscript.eval import AstEval
-from homeassistant.const import SUN_EVENT_SUNRISE, SUN_EVENT_SUNSET
+from homeassistant.components.pyscript.handler import LAG_CHECK_INTERVAL
+from homeassistant.const import (
+    EVENT_CORE_CONFIG_UPDATE,
+    SUN_EVENT_SUNRISE,
+    SUN_EVENT_SUNSET,
+)
 import homeassistant.helpers.sun as sun
 from homeassistant.util import dt as dt_util
 
 _LOGGER = logging.getLogger(__name__)
 
+#
+# Maximum number of sunrise/sunset times we cache; the cache is simply
+# flushed when it gets this big, since only a few days are ever in use.
+#
+SUN_CACHE_MAX = 32
+
+#
+# Maximum number of distinct task.wait_until conditions we keep parsed, and
+# the number of idle parsed copies of each one we keep for reuse.
+#
+WAIT_EXPR_CACHE_MAX = 256
+WAIT_EXPR_POOL_MAX = 4
+
 
 def dt_now():
     """Return current time."""
@@ -93,6 +114,7 @@ class TrigTime:
     def __init__(self, hass=None, handler_func=None):
         """Create a new TrigTime."""
         self.hass = hass
+        self.handler = handler_func
 
         def wait_until_factory(ast_ctx):
             """Return wapper to call to astFunction with the ast context."""
@@ -118,6 +140,224 @@ class TrigTime:
             ] = i
             self.dow2int[locale.nl_langinfo(getattr(locale, f"DAY_{i+1}")).lower()] = i
 
+        #
+        # Cache of local sunrise and sunset times, keyed by event, date and
+        # location.  Astral computations are expensive, and time_active
+        # checks with sunrise or sunset happen on every trigger.  The location
+        # is part of the key, but we also flush the cache whenever the core
+        # config changes so stale entries don't linger.
+        #
+        self.sun_cache = {}
+        if hass:
+            hass.bus.async_listen(EVENT_CORE_CONFIG_UPDATE, self.sun_cache_clear)
+
+        #
+        # Central timer for time triggers.  Rather than each trigger sleeping
+        # in its own task, timers are kept here grouped by their due time, so
+        # all triggers due at the same instant (eg, the same cron spec) are
+        # woken together and dispatched in a single pass.  timer_due maps the
+        # due time to a dict of {key: func}, and timer_key2time maps each key
+        # back to its due time.  Only one loop timer is pending at any time,
+        # for the earliest due time.
+        #
+        self.timer_due = {}
+        self.timer_key2time = {}
+        self.timer_handle = None
+        self.timer_handle_time = None
+
+        #
+        # Trigger expressions that only depend on state variables are shared
+        # by every trigger that uses the same one, keyed by their AST dump.
+        # Entries disappear once no trigger refers to them.
+        #
+        self.expr_shared = weakref.WeakValueDictionary()
+
+        #
+        # Parsed task.wait_until conditions, keyed by kind ("state" or
+        # "event"), function name and expression.  Each entry holds the state
+        # names or event data conditions derived from the expression, and a
+        # pool of idle parsed contexts, so a loop that waits on the same
+        # condition doesn't build and parse a new one every time.  A context
+        # is only used by one waiter at a time, since eval() changes its
+        # local symbols.
+        #
+        self.wait_expr_cache = {}
+
+    async def sun_cache_clear(self, event):
+        """Flush the sunrise and sunset cache when the core config changes."""
+        _LOGGER.debug("core config updated; flushing sun cache")
+        self.sun_cache = {}
+
+    def sun_event_time(self, event, date):
+        """Return the local time of sunrise or sunset on the given date, or None."""
+        cfg = self.hass.config
+        key = (
+            event,
+            date,
+            cfg.latitude,
+            cfg.longitude,
+            cfg.elevation,
+            str(cfg.time_zone),
+        )
+        if key in self.sun_cache:
+            return self.sun_cache[key]
+        time_sun = sun.get_astral_event_date(self.hass, event, date)
+        if time_sun is not None:
+            time_sun = dt_util.as_local(time_sun)
+        if len(self.sun_cache) >= SUN_CACHE_MAX:
+            self.sun_cache = {}
+        self.sun_cache[key] = time_sun
+        return time_sun
+
+    def expr_share(self, ast_ctx):
+        """Return a shared TrigExpr for a parsed trigger expression, or ast_ctx if it can't be shared."""
+        if not ast_ctx.ast_state_only() or any(
+            ast_ctx.state.is_glob(name) for name in ast_ctx.ast_get_state_names()
+        ):
+            #
+            # wildcard values depend on which entity changed, so those
+            # aren't shared either
+            #
+            return ast_ctx
+        key = ast_ctx.dump()
+        expr = self.expr_shared.get(key)
+        if expr is None:
+            expr = TrigExpr(ast_ctx)
+            self.expr_shared[key] = expr
+        return expr
+
+    def wait_expr_new(self, ast_ctx, kind, expr):
+        """Return a new parsed AstEval for a wait_until condition."""
+        if kind == "state":
+            expr_ctx = AstEval(
+                f"{ast_ctx.name} wait_until state_trigger",
+                ast_ctx.global_sym_table,
+                state_func=ast_ctx.state,
+                event_func=ast_ctx.event,
+                handler_func=ast_ctx.handler,
+            )
+            ast_ctx.handler.install_ast_funcs(expr_ctx)
+            expr_ctx.parse(ast_ctx.state.glob_rewrite(expr))
+        else:
+            expr_ctx = AstEval(
+                f"trigger {ast_ctx.name} wait_until event_trigger",
+                ast_ctx.global_sym_table,
+                state_func=ast_ctx.state,
+                event_func=ast_ctx.event,
+                handler_func=ast_ctx.handler,
+            )
+            ast_ctx.handler.install_ast_funcs(expr_ctx)
+            expr_ctx.parse(expr)
+        return expr_ctx
+
+    def wait_expr_get(self, ast_ctx, kind, expr):
+        """Return the cache entry and an idle parsed AstEval for a wait_until condition."""
+        key = (kind, ast_ctx.name, tuple(expr) if isinstance(expr, list) else expr)
+        entry = self.wait_expr_cache.get(key, None)
+        if entry is not None and entry["global_sym_table"] is ast_ctx.global_sym_table:
+            if len(entry["pool"]) > 0:
+                return entry, entry["pool"].pop()
+            return entry, self.wait_expr_new(ast_ctx, kind, expr)
+        #
+        # new condition, or the function has been reloaded
+        #
+        if len(self.wait_expr_cache) >= WAIT_EXPR_CACHE_MAX:
+            self.wait_expr_cache = {}
+        expr_ctx = self.wait_expr_new(ast_ctx, kind, expr)
+        entry = {
+            "global_sym_table": ast_ctx.global_sym_table,
+            "pool": [],
+            "state_names": None,
+            "event_conds": None,
+        }
+        if kind == "state":
+            entry["state_names"] = expr_ctx.ast_get_state_names()
+        else:
+            entry["event_conds"] = expr_ctx.ast_get_index_conds()
+        self.wait_expr_cache[key] = entry
+        return entry, expr_ctx
+
+    def wait_expr_clear(self):
+        """Discard the parsed wait_until conditions, eg when scripts are reloaded.
+
+        Their contexts refer to the scripts' global symbol tables, which
+        would otherwise be kept alive.  Waiters that are still running
+        return their contexts to entries that are no longer cached.
+        """
+        self.wait_expr_cache = {}
+
+    def wait_expr_put(self, entry, expr_ctx):
+        """Return an AstEval from wait_expr_get to its pool once the waiter is done."""
+        if expr_ctx is None or len(entry["pool"]) >= WAIT_EXPR_POOL_MAX:
+            return
+        expr_ctx.notify_vars = None
+        entry["pool"].append(expr_ctx)
+
+    def timer_add(self, key, time_due, func):
+        """Call coroutine func(time_due) at time_due, replacing any timer with the same key."""
+        self.timer_del(key)
+        if time_due not in self.timer_due:
+            self.timer_due[time_due] = {}
+        self.timer_due[time_due][key] = func
+        self.timer_key2time[key] = time_due
+        if self.timer_handle_time is None or time_due < self.timer_handle_time:
+            self.timer_schedule()
+
+    def timer_pending(self, key):
+        """Return whether a timer with the given key is pending."""
+        return key in self.timer_key2time
+
+    def timer_del(self, key):
+        """Remove any pending timer with the given key."""
+        time_due = self.timer_key2time.pop(key, None)
+        if time_due is None:
+            return
+        del self.timer_due[time_due][key]
+        if len(self.timer_due[time_due]) == 0:
+            del self.timer_due[time_due]
+            #
+            # if this was the earliest time, wake up for the next one instead
+            #
+            if time_due == self.timer_handle_time:
+                self.timer_schedule()
+
+    def timer_schedule(self):
+        """Set the loop timer for the earliest due time."""
+        if self.timer_handle:
+            self.timer_handle.cancel()
+        self.timer_handle = None
+        self.timer_handle_time = None
+        if len(self.timer_due) == 0:
+            return
+        time_due = min(self.timer_due)
+        delay = (time_due - dt_now()).total_seconds()
+        _LOGGER.debug("timer next wakeup at %s (%s secs)", time_due, delay)
+        self.timer_handle_time = time_due
+        self.timer_handle = self.hass.loop.call_later(max(delay, 0), self.timer_wakeup)
+
+    def timer_wakeup(self):
+        """Loop timer callback; dispatch everything due at the scheduled time."""
+        time_due = self.timer_handle_time
+        self.timer_handle = None
+        self.timer_handle_time = None
+        funcs = self.timer_due.pop(time_due, {})
+        for key in funcs:
+            del self.timer_key2time[key]
+        self.timer_schedule()
+        if len(funcs) > 0:
+            self.handler.create_task(self.timer_dispatch(time_due, funcs))
+
+    async def timer_dispatch(self, time_due, funcs):
+        """Run all the timer functions due at time_due back to back."""
+        _LOGGER.debug("timer dispatching %d timers due at %s", len(funcs), time_due)
+        for func in funcs.values():
+            try:
+                await func(time_due)
+            except asyncio.CancelledError:  # pylint: disable=try-except-raise
+                raise
+            except Exception:  # pylint: disable=broad-except
+                _LOGGER.error("timer_dispatch: %s", traceback.format_exc(-1))
+
     async def wait_until(
         self,
         ast_ctx,
@@ -136,24 +376,21 @@ class TrigTime:
             return {"trigger_type": "none"}
         state_trig_ident = None
         state_trig_expr = None
+        state_trig_entry = None
         event_trig_expr = None
-        notify_q = asyncio.Queue(0)
+        event_trig_entry = None
+        notify_q = ast_ctx.handler.notify_queue()
         if state_trigger is not None:
-            state_trig_expr = AstEval(
-                f"{ast_ctx.name} wait_until state_trigger",
-                ast_ctx.global_sym_table,
-                state_func=ast_ctx.state,
-                event_func=ast_ctx.event,
-                handler_func=ast_ctx.handler,
+            state_trig_entry, state_trig_expr = self.wait_expr_get(
+                ast_ctx, "state", state_trigger
             )
-            ast_ctx.handler.install_ast_funcs(state_trig_expr)
-            state_trig_expr.parse(state_trigger)
             #
             # check straight away to see if the condition is met (to avoid race conditions)
             #
             if await state_trig_expr.eval():
+                self.wait_expr_put(state_trig_entry, state_trig_expr)
                 return {"trigger_type": "state"}
-            state_trig_ident = state_trig_expr.ast_get_names()
+            state_trig_ident = state_trig_entry["state_names"]
             _LOGGER.debug(
                 "trigger %s wait_until: watching vars %s",
                 ast_ctx.name,
@@ -164,17 +401,15 @@ class TrigTime:
         if event_trigger is not None:
             if isinstance(event_trigger, str):
                 event_trigger = [event_trigger]
-            ast_ctx.event.notify_add(event_trigger[0], notify_q)
+            event_trig_conds = None
             if len(event_trigger) > 1:
-                event_trig_expr = AstEval(
-                    f"trigger {ast_ctx.name} wait_until event_trigger",
-                    ast_ctx.global_sym_table,
-                    state_func=ast_ctx.state,
-                    event_func=ast_ctx.event,
-                    handler_func=ast_ctx.handler,
+                event_trig_entry, event_trig_expr = self.wait_expr_get(
+                    ast_ctx, "event", event_trigger[1]
                 )
-                ast_ctx.handler.install_ast_funcs(event_trig_expr)
-                event_trig_expr.parse(event_trigger[1])
+                event_trig_conds = event_trig_entry["event_conds"]
+            ast_ctx.event.notify_add(
+                event_trigger[0], notify_q, data_conds=event_trig_conds
+            )
         time0 = time.monotonic()
         while 1:
             this_timeout = None
@@ -219,11 +454,15 @@ class TrigTime:
             if notify_type == "state":
                 new_vars = notify_info[0] if notify_info else None
                 if state_trig_expr is None or await state_trig_expr.eval(new_vars):
-                    ret = notify_info[1] if notify_info else None
+                    ret = dict(notify_info[1]) if notify_info else None
                     break
             elif notify_type == "event":
                 if event_trig_expr is None or await event_trig_expr.eval(notify_info):
-                    ret = notify_info
+                    #
+                    # notify_info is shared by all subscribers, so the
+                    # caller gets its own copy
+                    #
+                    ret = dict(notify_info)
                     break
             else:
                 _LOGGER.error(
@@ -237,6 +476,10 @@ class TrigTime:
                 ast_ctx.state.notify_del(name, notify_q)
         if event_trigger is not None:
             ast_ctx.event.notify_del(event_trigger[0], notify_q)
+        if state_trig_entry is not None:
+            self.wait_expr_put(state_trig_entry, state_trig_expr)
+        if event_trig_entry is not None:
+            self.wait_expr_put(event_trig_entry, event_trig_expr)
         _LOGGER.debug("trigger %s wait_until returning %s", ast_ctx.name, ret)
         return ret
 
@@ -304,14 +547,14 @@ class TrigTime:
                 hour, mins, sec = int(match0[1]), int(match0[2]), 0
         elif dt_str.startswith("sunrise") or dt_str.startswith("sunset"):
             if dt_str.startswith("sunrise"):
-                time_sun = sun.get_astral_event_date(self.hass, SUN_EVENT_SUNRISE)
+                sun_event = SUN_EVENT_SUNRISE
             else:
-                time_sun = sun.get_astral_event_date(self.hass, SUN_EVENT_SUNSET)
+                sun_event = SUN_EVENT_SUNSET
+            time_sun = self.sun_event_time(sun_event, datetime.date(year, month, day))
             if time_sun is None:
                 _LOGGER.warning("'%s' not defined at this latitude", dt_str)
                 # return something in the past so it is ignored
                 return now - datetime.timedelta(days=100)
-            time_sun = dt_util.as_local(time_sun)
             hour, mins, sec = time_sun.hour, time_sun.minute, time_sun.second
             _LOGGER.debug(
                 "trigger: got %s = %02d:%02d:%02d (t = %s)",
@@ -582,6 +825,82 @@ class TrigTime:
         return next_time
 
 
+class TrigExpr:
+    """Trigger expression shared by all the triggers that use it.
+
+    The expression only depends on state variables (see AstEval.ast_state_only),
+    so values are cached together with the version numbers of those state
+    variables, and only evaluated again once one of them changes.  If the
+    expression is an "and" or "or" of several terms, each term is cached
+    separately, so only the terms whose state variables changed are evaluated.
+    """
+
+    def __init__(self, ast_ctx):
+        """Create a new shared expression from a parsed AstEval."""
+        self.ast_ctx = ast_ctx
+        self.state = ast_ctx.state
+        self.state_names = ast_ctx.ast_get_state_names()
+        self.users = 0
+        expr = ast_ctx.ast.body[0].value
+        if isinstance(expr, ast.BoolOp):
+            self.bool_op = expr.op
+            nodes = expr.values
+        else:
+            self.bool_op = None
+            nodes = [expr]
+        #
+        # each term is [ast_node, state_names, version, value]
+        #
+        self.terms = [
+            [node, ast_ctx.ast_get_state_names(node), None, None] for node in nodes
+        ]
+
+    def start(self):
+        """Note another running trigger uses this expression."""
+        if self.users == 0:
+            self.state.version_add(self.state_names)
+        self.users += 1
+
+    def stop(self):
+        """Note a trigger using this expression has stopped."""
+        self.users -= 1
+        if self.users == 0:
+            self.state.version_del(self.state_names)
+            for term in self.terms:
+                term[2] = None
+
+    async def eval_term(self, term):
+        """Return the value of one term, evaluating it only if a state variable changed."""
+        version = self.state.version_get(term[1])
+        if version is None or version != term[2]:
+            term[3] = await self.ast_ctx.aeval(term[0])
+            term[2] = version
+        return term[3]
+
+    async def eval(self, new_state_vars=None):
+        """Return the value of the expression, with the same semantics as AstEval.eval()."""
+        #
+        # the context is shared, so don't leave another trigger's notified
+        # values in place
+        #
+        self.ast_ctx.notify_vars = new_state_vars if new_state_vars else None
+        if self.bool_op is None:
+            return await self.eval_term(self.terms[0])
+        if isinstance(self.bool_op, ast.And):
+            val = 1
+            for term in self.terms:
+                this_val = await self.eval_term(term)
+                if this_val == 0:
+                    return 0
+                val = this_val
+            return val
+        for term in self.terms:
+            val = await self.eval_term(term)
+            if val != 0:
+                return val
+        return 0
+
+
 class TrigInfo:
     """Class for all trigger-decorated functions."""
 
@@ -596,7 +915,7 @@ class TrigInfo:
     ):
         """Create a new TrigInfo."""
         self.name = name
-        self.task = None
+        self.started = False
         self.trig_cfg = trig_cfg
         self.state_trigger = trig_cfg.get("state_trigger", None)
         self.time_trigger = trig_cfg.get("time_trigger", None)
@@ -606,12 +925,14 @@ class TrigInfo:
         self.action = trig_cfg.get("action")
         self.action_ast_ctx = trig_cfg.get("action_ast_ctx")
         self.global_sym_table = trig_cfg.get("global_sym_table", {})
-        self.notify_q = asyncio.Queue(0)
         self.active_expr = None
         self.state_trig_expr = None
         self.state_trig_ident = None
         self.event_trig_expr = None
-        self.have_trigger = False
+        self.event_trig_conds = None
+        self.state_hold = None
+        self.state_hold_false = None
+        self.state_false_time = None
         self.event = event_func
         self.state = state_func
         self.handler = handler_func
@@ -619,6 +940,70 @@ class TrigInfo:
 
         _LOGGER.debug("trigger %s event_trigger = %s", self.name, self.event_trigger)
 
+        #
+        # time triggers that are only periodic can be deferred while the
+        # event loop is lagging
+        #
+        self.time_trigger_periodic = bool(self.time_trigger) and all(
+            spec.strip().startswith("period(") for spec in self.time_trigger
+        )
+
+        state_trigger_kwargs = trig_cfg.get("state_trigger_kwargs", {})
+        for kwarg in ["state_hold", "state_hold_false"]:
+            setattr(
+                self,
+                kwarg,
+                self.kwarg_seconds("state_trigger", kwarg, state_trigger_kwargs),
+            )
+
+        #
+        # Optional debounce, throttle and sample policies for the state and
+        # event triggers, applied before any task is created, and the
+        # bookkeeping they need, keyed by trigger type.
+        #
+        self.rate_cfg = {}
+        self.rate_info = {}
+        for trig_type in ["state", "event"]:
+            dec_name = f"{trig_type}_trigger"
+            kwargs = trig_cfg.get(f"{dec_name}_kwargs", {})
+            cfg = {
+                "debounce": self.kwarg_seconds(dec_name, "debounce", kwargs),
+                "throttle": self.kwarg_seconds(dec_name, "throttle", kwargs),
+                "throttle_mode": kwargs.get("throttle_mode", "leading"),
+                "sample": kwargs.get("sample", None),
+            }
+            if cfg["throttle_mode"] not in {"leading", "trailing"}:
+                _LOGGER.error(
+                    "trigger %s: @%s throttle_mode must be 'leading' or 'trailing'; ignored",
+                    self.name,
+                    dec_name,
+                )
+                cfg["throttle_mode"] = "leading"
+            if cfg["sample"] is not None and (
+                not isinstance(cfg["sample"], int) or cfg["sample"] < 1
+            ):
+                _LOGGER.error(
+                    "trigger %s: @%s sample must be a positive integer; ignored",
+                    self.name,
+                    dec_name,
+                )
+                cfg["sample"] = None
+            if cfg["debounce"] is not None and cfg["throttle"] is not None:
+                _LOGGER.error(
+                    "trigger %s: @%s can't have both debounce and throttle; ignoring throttle",
+                    self.name,
+                    dec_name,
+                )
+                cfg["throttle"] = None
+            if (
+                cfg["debounce"] is None
+                and cfg["throttle"] is None
+                and cfg["sample"] is None
+            ):
+                continue
+            self.rate_cfg[trig_type] = cfg
+            self.rate_info[trig_type] = {"count": 0, "last": None, "func_args": None}
+
         if self.state_active is not None:
             self.active_expr = AstEval(
                 f"trigger {self.name} state_active",
@@ -629,9 +1014,7 @@ class TrigInfo:
             )
             self.handler.install_ast_funcs(self.active_expr)
             self.active_expr.parse(self.state_active)
-
-        if self.time_trigger is not None:
-            self.have_trigger = True
+            self.active_expr = self.trig_time.expr_share(self.active_expr)
 
         if self.state_trigger is not None:
             self.state_trig_expr = AstEval(
@@ -642,20 +1025,14 @@ class TrigInfo:
                 handler_func=self.handler,
             )
             self.handler.install_ast_funcs(self.state_trig_expr)
-            self.state_trig_expr.parse(self.state_trigger)
-            self.state_trig_ident = self.state_trig_expr.ast_get_names()
+            self.state_trig_expr.parse(self.state.glob_rewrite(self.state_trigger))
+            self.state_trig_ident = self.state_trig_expr.ast_get_state_names()
+            self.state_trig_expr = self.trig_time.expr_share(self.state_trig_expr)
             _LOGGER.debug(
                 "trigger %s: watching vars %s", self.name, self.state_trig_ident
             )
-            if len(self.state_trig_ident) > 0:
-                self.state.notify_add(self.state_trig_ident, self.notify_q)
-            self.have_trigger = True
 
         if self.event_trigger is not None:
-            _LOGGER.debug(
-                "trigger %s adding event_trigger %s", self.name, self.event_trigger[0]
-            )
-            self.event.notify_add(self.event_trigger[0], self.notify_q)
             if len(self.event_trigger) == 2:
                 self.event_trig_expr = AstEval(
                     f"trigger {self.name} event_trigger",
@@ -666,185 +1043,292 @@ class TrigInfo:
                 )
                 self.handler.install_ast_funcs(self.event_trig_expr)
                 self.event_trig_expr.parse(self.event_trigger[1])
-            self.have_trigger = True
+                self.event_trig_conds = self.event_trig_expr.ast_get_index_conds()
 
     async def stop(self):
-        """Stop this trigger task."""
+        """Stop this trigger."""
 
-        if self.task:
+        if self.started:
             if self.state_trig_ident:
-                self.state.notify_del(self.state_trig_ident, self.notify_q)
+                self.state.notify_del(self.state_trig_ident, self)
             if self.event_trigger is not None:
-                self.event.notify_del(self.event_trigger[0], self.notify_q)
-            if self.task:
-                try:
-                    self.task.cancel()
-                    await self.task
-                except asyncio.CancelledError:
-                    pass
-            self.task = None
+                self.event.notify_del(self.event_trigger[0], self)
+            self.trig_time.timer_del(self)
+            self.trig_time.timer_del((self, "hold"))
+            for trig_type in self.rate_cfg:
+                self.trig_time.timer_del((self, trig_type, "rate"))
+            for expr in [self.state_trig_expr, self.active_expr]:
+                if isinstance(expr, TrigExpr):
+                    expr.stop()
+            self.started = False
         _LOGGER.debug("trigger %s is stopped", self.name)
 
     def start(self):
-        """Start this trigger task."""
-        self.task = self.handler.create_task(self.trigger_watch())
+        """Start this trigger.
+
+        There is no task per trigger: State.update() and Event.update() call
+        notify_state() and notify_event() directly, and time triggers are
+        dispatched by the central timer in TrigTime.  A task is only created
+        when an action actually runs.
+        """
+        self.started = True
+        for expr in [self.state_trig_expr, self.active_expr]:
+            if isinstance(expr, TrigExpr):
+                expr.start()
+        if self.state_hold_false is not None:
+            #
+            # the expression counts as having been false for long enough
+            # when we start, so it can trigger as soon as it is true
+            #
+            self.state_false_time = dt_now() - datetime.timedelta(
+                seconds=self.state_hold_false
+            )
+        if self.state_trig_ident:
+            for name in self.state_trig_ident:
+                #
+                # pyscript state variables are created by scripts, so they
+                # legitimately might not exist yet, and wildcards don't
+                # refer to a single entity
+                #
+                if (
+                    not name.startswith("pyscript.")
+                    and not self.state.is_glob(name)
+                    and not self.state.exist(".".join(name.split(".")[0:2]))
+                ):
+                    _LOGGER.warning(
+                        "trigger %s: state_trigger refers to unknown entity %s",
+                        self.name,
+                        name,
+                    )
+            self.state.notify_add(self.state_trig_ident, self)
+        if self.event_trigger is not None:
+            _LOGGER.debug(
+                "trigger %s adding event_trigger %s", self.name, self.event_trigger[0]
+            )
+            self.event.notify_add(
+                self.event_trigger[0], self, data_conds=self.event_trig_conds
+            )
+        if self.time_trigger:
+            self.time_trigger_schedule(dt_now())
+        if (
+            self.state_trigger is None
+            and self.time_trigger is None
+            and self.event_trigger is None
+        ):
+            #
+            # empty triggers mean run the function once at startup
+            #
+            self.handler.create_task(self.notify_state({}, {}))
         _LOGGER.debug("trigger %s is active", self.name)
 
-    async def trigger_watch(self):
-        """Task that runs for each trigger, waiting for the next trigger and calling the function."""
+    def time_trigger_schedule(self, now):
+        """Schedule our next time trigger after now with the central timer."""
+        time_next = self.trig_time.timer_trigger_next(self.time_trigger, now)
+        _LOGGER.debug("trigger %s time_next = %s, now = %s", self.name, time_next, now)
+        if time_next is not None:
+            self.trig_time.timer_add(self, time_next, self.time_trigger_fired)
 
-        while 1:
-            try:
-                timeout = None
-                notify_info = None
-                notify_type = None
-                if self.time_trigger:
-                    now = dt_now()
-                    time_next = self.trig_time.timer_trigger_next(
-                        self.time_trigger, now
-                    )
-                    _LOGGER.debug(
-                        "trigger %s time_next = %s, now = %s", self.name, time_next, now
-                    )
-                    if time_next is not None:
-                        timeout = (time_next - now).total_seconds()
-                if timeout is None and self.have_trigger:
-                    _LOGGER.debug(
-                        "trigger %s waiting for state change or event", self.name
+    async def time_trigger_fired(self, time_due):
+        """Handle our time trigger, called by the central timer when it is due."""
+        if not self.started:
+            return
+        if self.time_trigger_periodic and self.handler.lagging():
+            #
+            # defer until the lag has gone; missed periods collapse into one
+            #
+            _LOGGER.debug("trigger %s deferring period trigger", self.name)
+            self.handler.stats["lag_deferred"] += 1
+            self.trig_time.timer_add(
+                self,
+                dt_now() + datetime.timedelta(seconds=LAG_CHECK_INTERVAL),
+                self.time_trigger_fired,
+            )
+            return
+        #
+        # schedule the next one from the later of now and the due time, so
+        # an early wakeup can't cause the same time to trigger twice
+        #
+        self.time_trigger_schedule(max(dt_now(), time_due))
+        await self.action_run({"trigger_type": "time"})
+
+    def kwarg_seconds(self, dec_name, kwarg, kwargs):
+        """Return a decorator keyword argument that is a number of seconds, or None."""
+        value = kwargs.get(kwarg, None)
+        if value is not None and (not isinstance(value, (int, float)) or value < 0):
+            _LOGGER.error(
+                "trigger %s: @%s %s must be a non-negative number of seconds; ignored",
+                self.name,
+                dec_name,
+                kwarg,
+            )
+            value = None
+        return value
+
+    async def rate_limit_run(self, trig_type, func_args, new_vars=None):
+        """Apply any debounce, throttle or sample policy, and run the action if it allows.
+
+        Deferred runs (debounce and trailing throttle) use the central timer
+        and the most recent func_args, and check state_active and time_active
+        when they are due.  Notifications are skipped while the event loop
+        is lagging.
+        """
+        cfg = self.rate_cfg.get(trig_type, None)
+        if cfg is None:
+            await self.action_run(func_args, new_vars)
+            return
+        if self.handler.lagging():
+            #
+            # a rate-limited trigger can tolerate missing notifications, so
+            # we shed them while the event loop is lagging
+            #
+            self.handler.stats["lag_skipped"] += 1
+            return
+        info = self.rate_info[trig_type]
+        if cfg["sample"] is not None:
+            info["count"] += 1
+            if info["count"] < cfg["sample"]:
+                return
+            info["count"] = 0
+        now = dt_now()
+        if cfg["debounce"] is not None:
+            info["func_args"] = [func_args, new_vars]
+            self.trig_time.timer_add(
+                (self, trig_type, "rate"),
+                now + datetime.timedelta(seconds=cfg["debounce"]),
+                self.rate_limit_fired_factory(trig_type),
+            )
+            return
+        if cfg["throttle"] is not None:
+            if cfg["throttle_mode"] == "trailing":
+                info["func_args"] = [func_args, new_vars]
+                if not self.trig_time.timer_pending((self, trig_type, "rate")):
+                    self.trig_time.timer_add(
+                        (self, trig_type, "rate"),
+                        now + datetime.timedelta(seconds=cfg["throttle"]),
+                        self.rate_limit_fired_factory(trig_type),
                     )
-                    notify_type, notify_info = await self.notify_q.get()
-                elif timeout is not None:
-                    try:
-                        _LOGGER.debug(
-                            "trigger %s waiting for %s secs", self.name, timeout
-                        )
-                        notify_type, notify_info = await asyncio.wait_for(
-                            self.notify_q.get(), timeout=timeout
-                        )
-                    except asyncio.TimeoutError:
-                        notify_info = {"trigger_type": "time"}
-                        if (
-                            (not self.active_expr or await self.active_expr.eval())
-                            and (
-                                not self.time_active
-                                or self.trig_time.timer_active_check(
-                                    self.time_active, dt_now()
-                                )
-                            )
-                            and self.action
-                        ):
-                            _LOGGER.debug(
-                                "trigger %s got time_trigger, running action", self.name
-                            )
-                            self.handler.create_task(
-                                self.action.call(
-                                    self.action_ast_ctx, kwargs=notify_info
-                                )
-                            )
-                        else:
-                            _LOGGER.debug(
-                                "trigger %s got time_trigger, but not active", self.name
-                            )
-                        continue
-                if notify_type == "state" or notify_type is None:
-                    if notify_info:
-                        new_vars, func_args = notify_info
-                    else:
-                        new_vars, func_args = {}, {}
-                    if (
-                        (
-                            self.state_trig_expr is None
-                            or await self.state_trig_expr.eval(new_vars)
-                        )
-                        and (
-                            self.active_expr is None
-                            or await self.active_expr.eval(new_vars)
-                        )
-                        and (
-                            self.time_active is None
-                            or self.trig_time.timer_active_check(
-                                self.time_active, dt_now()
-                            )
-                        )
-                        and self.action
-                    ):
-                        _LOGGER.debug(
-                            "trigger %s state_trig_expr = %s based on %s",
-                            self.name,
-                            await self.state_trig_expr.eval(new_vars)
-                            if self.state_trig_expr
-                            else None,
-                            new_vars,
-                        )
-                        _LOGGER.debug(
-                            "trigger %s got state_trig_expr, running action (kwargs = %s)",
-                            self.name,
-                            func_args,
-                        )
-                        self.handler.create_task(
-                            self.action.call(self.action_ast_ctx, kwargs=func_args)
-                        )
-                    else:
-                        _LOGGER.debug(
-                            "trigger %s got state_trig_expr, but not active", self.name
-                        )
-                        # _LOGGER.debug(f'state_trig_expr = {await self.state_trig_expr.eval(new_vars) if self.state_trig_expr else None}')
-                        # _LOGGER.debug(f'timerActive = {self.trig_time.timer_active_check(self.time_active, dt_now())
-                        #                                                       if self.time_active else None}')
-                elif notify_type == "event":
-                    if (
-                        (
-                            self.event_trig_expr is None
-                            or await self.event_trig_expr.eval(notify_info)
-                        )
-                        and (
-                            self.active_expr is None
-                            or await self.active_expr.eval(notify_info)
-                        )
-                        and (
-                            self.time_active is None
-                            or self.trig_time.timer_active_check(
-                                self.time_active, dt_now()
-                            )
-                        )
-                        and self.action
-                    ):
+                return
+            if (
+                info["last"] is not None
+                and (now - info["last"]).total_seconds() < cfg["throttle"]
+            ):
+                return
+            info["last"] = now
+        await self.action_run(func_args, new_vars)
+
+    def rate_limit_fired_factory(self, trig_type):
+        """Return the central timer function for a deferred debounce or throttle run."""
+
+        async def rate_limit_fired(time_due):
+            func_args, new_vars = self.rate_info[trig_type]["func_args"]
+            self.rate_info[trig_type]["func_args"] = None
+            if self.started:
+                await self.action_run(func_args, new_vars)
+
+        return rate_limit_fired
+
+    async def action_run(self, func_args, new_vars=None):
+        """Check state_active and time_active, and run the action if they pass."""
+        if (
+            (self.active_expr is None or await self.active_expr.eval(new_vars))
+            and (
+                self.time_active is None
+                or self.trig_time.timer_active_check(self.time_active, dt_now())
+            )
+            and self.action
+        ):
+            _LOGGER.debug(
+                "trigger %s got %s trigger, running action (kwargs = %s)",
+                self.name,
+                func_args.get("trigger_type", None),
+                func_args,
+            )
+            self.handler.create_task(
+                self.action.call(self.action_ast_ctx, kwargs=func_args),
+                name=self.name,
+            )
+        else:
+            _LOGGER.debug(
+                "trigger %s got %s trigger, but not active",
+                self.name,
+                func_args.get("trigger_type", None),
+            )
+
+    def state_edge_check(self, trig_ok):
+        """Apply state_hold_false, so we only trigger once the expression was false long enough."""
+        now = dt_now()
+        if not trig_ok:
+            if self.state_false_time is None:
+                self.state_false_time = now
+            return False
+        if self.state_false_time is None:
+            #
+            # still true since the last time; not a new transition
+            #
+            return False
+        false_time, self.state_false_time = self.state_false_time, None
+        return (now - false_time).total_seconds() >= self.state_hold_false
+
+    async def state_hold_fired(self, time_due, func_args):
+        """Run the action once the state trigger has stayed true for state_hold seconds."""
+        if self.started:
+            await self.rate_limit_run("state", func_args)
+
+    async def notify_state(self, new_vars, func_args):
+        """Check a state variable change, and run the action if it triggers."""
+        try:
+            if self.state_trig_expr is not None:
+                trig_ok = await self.state_trig_expr.eval(new_vars)
+                hold_pending = self.trig_time.timer_pending((self, "hold"))
+                if self.state_hold_false is not None and not hold_pending:
+                    trig_ok = self.state_edge_check(trig_ok)
+                if self.state_hold is not None:
+                    #
+                    # the hold timer is cancelled if the expression becomes
+                    # false, and otherwise left to run its course
+                    #
+                    if not trig_ok:
+                        self.trig_time.timer_del((self, "hold"))
+                        if self.state_hold_false is not None and hold_pending:
+                            self.state_false_time = dt_now()
+                    elif not hold_pending:
                         _LOGGER.debug(
-                            "trigger %s got event_trig_expr, running action (kwargs = %s)",
+                            "trigger %s starting state_hold of %s sec",
                             self.name,
-                            notify_info,
-                        )
-                        self.handler.create_task(
-                            self.action.call(self.action_ast_ctx, kwargs=notify_info)
+                            self.state_hold,
                         )
-                    else:
-                        _LOGGER.debug(
-                            "trigger %s got event_trig_expr, but not active", self.name
+
+                        async def hold_fired(time_due):
+                            await self.state_hold_fired(time_due, func_args)
+
+                        self.trig_time.timer_add(
+                            (self, "hold"),
+                            dt_now() + datetime.timedelta(seconds=self.state_hold),
+                            hold_fired,
                         )
-                elif notify_type is not None:
-                    _LOGGER.error(
-                        "trigger %s got unexpected queue message %s",
-                        self.name,
-                        notify_type,
+                    return
+                if not trig_ok:
+                    _LOGGER.debug(
+                        "trigger %s got state_trig_expr, but not true", self.name
                     )
-
-                #
-                # if there is no time, event or state trigger, then quit
-                # (empty triggers mean run the function once at startup)
-                #
-                if (
-                    self.state_trigger is None
-                    and self.time_trigger is None
-                    and self.event_trigger is None
-                ):
-                    _LOGGER.debug("trigger %s returning", self.name)
                     return
-            except asyncio.CancelledError:  # pylint: disable=try-except-raise
-                raise
-            except Exception:  # pylint: disable=broad-except
-                # _LOGGER.error(f"{self.name}: " + traceback.format_exc(-1))
-                if self.state_trig_ident:
-                    self.state.notify_del(self.state_trig_ident, self.notify_q)
-                if self.event_trigger is not None:
-                    self.event.notify_del(self.event_trigger[0], self.notify_q)
+            await self.rate_limit_run("state", func_args, new_vars)
+        except asyncio.CancelledError:  # pylint: disable=try-except-raise
+            raise
+        except Exception:  # pylint: disable=broad-except
+            _LOGGER.error("trigger %s: %s", self.name, traceback.format_exc(-1))
+
+    async def notify_event(self, func_args):
+        """Check an event, and run the action if it triggers."""
+        try:
+            if (
+                self.event_trig_expr is not None
+                and not await self.event_trig_expr.eval(func_args)
+            ):
+                _LOGGER.debug("trigger %s got event_trig_expr, but not true", self.name)
                 return
+            await self.rate_limit_run("event", func_args, func_args)
+        except asyncio.CancelledError:  # pylint: disable=try-except-raise
+            raise
+        except Exception:  # pylint: disable=broad-except
+            _LOGGER.error("trigger %s: %s", self.name, traceback.format_exc(-1))
@@ -344,3 +344,585 @@ def func4(trigger_type=None, event_type=None, **kwargs):
         ]
 
     assert "name 'no_such_function' is not defined" in caplog.text
+
+
+async def test_state_trigger_attr(hass, caplog):
+    """Test state triggers only wake on the state value or attributes they mention."""
+    notify_q = asyncio.Queue(0)
+    await setup_script(
+        hass,
+        notify_q,
+        [dt(2020, 7, 1, 10, 59, 59, 999999), dt(2020, 7, 1, 11, 59, 59, 999999)],
+        """
+
+seq_num = 0
+
+@time_trigger("once(2020/07/01 11:00:00)")
+def func_startup_sync():
+    global seq_num
+
+    seq_num += 1
+    pyscript.done = seq_num
+
+@state_trigger("True or pyscript.a1")
+def func_state(value=None):
+    global seq_num
+
+    seq_num += 1
+    pyscript.done = [seq_num, "state", value]
+
+@state_trigger("pyscript.a1.attr1 == 5")
+def func_attr(value=None):
+    global seq_num
+
+    seq_num += 1
+    pyscript.done = [seq_num, "attr", value]
+""",
+    )
+    seq_num = 0
+
+    seq_num += 1
+    # fire event to start triggers, and handshake when they are running
+    hass.bus.async_fire(EVENT_HOMEASSISTANT_STARTED)
+    assert literal_eval(await wait_until_done(notify_q)) == seq_num
+
+    seq_num += 1
+    hass.states.async_set("pyscript.a1", "on", {"attr1": 1, "attr2": 1})
+    assert literal_eval(await wait_until_done(notify_q)) == [seq_num, "state", "on"]
+
+    #
+    # changing attr2 wakes neither trigger; changing attr1 only wakes func_attr
+    #
+    seq_num += 1
+    hass.states.async_set("pyscript.a1", "on", {"attr1": 1, "attr2": 2})
+    hass.states.async_set("pyscript.a1", "on", {"attr1": 5, "attr2": 2})
+    assert literal_eval(await wait_until_done(notify_q)) == [seq_num, "attr", "on"]
+
+    #
+    # changing the state only wakes func_state
+    #
+    seq_num += 1
+    hass.states.async_set("pyscript.a1", "off", {"attr1": 5, "attr2": 2})
+    assert literal_eval(await wait_until_done(notify_q)) == [seq_num, "state", "off"]
+
+
+async def test_state_trigger_wildcard(hass, caplog):
+    """Test state triggers with wildcard entity names."""
+    notify_q = asyncio.Queue(0)
+    await setup_script(
+        hass,
+        notify_q,
+        [dt(2020, 7, 1, 10, 59, 59, 999999), dt(2020, 7, 1, 11, 59, 59, 999999)],
+        """
+
+seq_num = 0
+
+@time_trigger("once(2020/07/01 11:00:00)")
+def func_startup_sync():
+    global seq_num
+
+    seq_num += 1
+    pyscript.done = seq_num
+
+@state_trigger("pyscript.door_* == 'on'")
+def func_door(var_name=None):
+    global seq_num
+
+    seq_num += 1
+    pyscript.done = [seq_num, "door", var_name]
+
+@state_trigger("input_number.* != input_number.*.old")
+def func_domain(var_name=None, value=None):
+    global seq_num
+
+    seq_num += 1
+    pyscript.done = [seq_num, "domain", var_name, value]
+""",
+    )
+    seq_num = 0
+
+    seq_num += 1
+    # fire event to start triggers, and handshake when they are running
+    hass.bus.async_fire(EVENT_HOMEASSISTANT_STARTED)
+    assert literal_eval(await wait_until_done(notify_q)) == seq_num
+    assert "unknown entity" not in caplog.text
+
+    #
+    # pyscript.window and pyscript.door_back = "off" don't match
+    #
+    seq_num += 1
+    hass.states.async_set("pyscript.window", "on")
+    hass.states.async_set("pyscript.door_back", "off")
+    hass.states.async_set("pyscript.door_front", "on")
+    assert literal_eval(await wait_until_done(notify_q)) == [
+        seq_num,
+        "door",
+        "pyscript.door_front",
+    ]
+
+    seq_num += 1
+    hass.states.async_set("input_number.n1", "5")
+    assert literal_eval(await wait_until_done(notify_q)) == [
+        seq_num,
+        "domain",
+        "input_number.n1",
+        "5",
+    ]
+
+
+async def test_state_active_shared(hass, caplog):
+    """Test triggers sharing the same state_active expression."""
+    notify_q = asyncio.Queue(0)
+    await setup_script(
+        hass,
+        notify_q,
+        [dt(2020, 7, 1, 10, 59, 59, 999999), dt(2020, 7, 1, 11, 59, 59, 999999)],
+        """
+
+seq_num = 0
+
+@time_trigger("once(2020/07/01 11:00:00)")
+def func_startup_sync():
+    global seq_num
+
+    seq_num += 1
+    pyscript.done = seq_num
+
+@state_trigger("pyscript.a1 == '1'")
+@state_active("pyscript.enabled == 'on'")
+def func1():
+    global seq_num
+
+    seq_num += 1
+    pyscript.done = [seq_num, "func1"]
+
+@state_trigger("pyscript.a2 == '1'")
+@state_active("pyscript.enabled  ==  'on'")
+def func2():
+    global seq_num
+
+    seq_num += 1
+    pyscript.done = [seq_num, "func2"]
+""",
+    )
+    seq_num = 0
+
+    seq_num += 1
+    # fire event to start triggers, and handshake when they are running
+    hass.bus.async_fire(EVENT_HOMEASSISTANT_STARTED)
+    assert literal_eval(await wait_until_done(notify_q)) == seq_num
+
+    hass.states.async_set("pyscript.enabled", "on")
+    seq_num += 1
+    hass.states.async_set("pyscript.a1", "1")
+    assert literal_eval(await wait_until_done(notify_q)) == [seq_num, "func1"]
+
+    #
+    # the shared guard has to notice pyscript.enabled changed
+    #
+    hass.states.async_set("pyscript.enabled", "off")
+    hass.states.async_set("pyscript.a1", "0")
+    hass.states.async_set("pyscript.a1", "1")
+    hass.states.async_set("pyscript.enabled", "on")
+    seq_num += 1
+    hass.states.async_set("pyscript.a2", "1")
+    assert literal_eval(await wait_until_done(notify_q)) == [seq_num, "func2"]
+
+
+async def test_state_trigger_edge(hass, caplog):
+    """Test state_hold_false only triggers when the expression changes from false to true."""
+    notify_q = asyncio.Queue(0)
+    await setup_script(
+        hass,
+        notify_q,
+        [dt(2020, 7, 1, 10, 59, 59, 999999), dt(2020, 7, 1, 11, 59, 59, 999999)],
+        """
+
+seq_num = 0
+
+@time_trigger("once(2020/07/01 11:00:00)")
+def func_startup_sync():
+    global seq_num
+
+    seq_num += 1
+    pyscript.done = seq_num
+
+@state_trigger("int(pyscript.level) > 10", state_hold_false=0)
+def func_edge(value=None):
+    global seq_num
+
+    seq_num += 1
+    pyscript.done = [seq_num, value]
+
+@state_trigger("pyscript.level", unknown_arg=1)
+def func_bad():
+    pass
+""",
+    )
+    seq_num = 0
+
+    seq_num += 1
+    # fire event to start triggers, and handshake when they are running
+    hass.bus.async_fire(EVENT_HOMEASSISTANT_STARTED)
+    assert literal_eval(await wait_until_done(notify_q)) == seq_num
+    assert "got unexpected keyword argument 'unknown_arg'" in caplog.text
+
+    seq_num += 1
+    hass.states.async_set("pyscript.level", "11")
+    assert literal_eval(await wait_until_done(notify_q)) == [seq_num, "11"]
+
+    #
+    # staying above 10 doesn't trigger again, until it drops below first
+    #
+    seq_num += 1
+    hass.states.async_set("pyscript.level", "12")
+    hass.states.async_set("pyscript.level", "5")
+    hass.states.async_set("pyscript.level", "13")
+    assert literal_eval(await wait_until_done(notify_q)) == [seq_num, "13"]
+
+
+async def test_event_trigger_sample(hass, caplog):
+    """Test event triggers that only run for one in every n events."""
+    notify_q = asyncio.Queue(0)
+    await setup_script(
+        hass,
+        notify_q,
+        [dt(2020, 7, 1, 10, 59, 59, 999999), dt(2020, 7, 1, 11, 59, 59, 999999)],
+        """
+
+seq_num = 0
+
+@time_trigger("once(2020/07/01 11:00:00)")
+def func_startup_sync():
+    global seq_num
+
+    seq_num += 1
+    pyscript.done = seq_num
+
+@event_trigger("test_event", "arg1 > 0", sample=3)
+def func_sample(arg1=None):
+    global seq_num
+
+    seq_num += 1
+    pyscript.done = [seq_num, arg1]
+
+@event_trigger("test_event", throttle_mode="sideways")
+def func_bad():
+    pass
+""",
+    )
+    seq_num = 0
+
+    seq_num += 1
+    # fire event to start triggers, and handshake when they are running
+    hass.bus.async_fire(EVENT_HOMEASSISTANT_STARTED)
+    assert literal_eval(await wait_until_done(notify_q)) == seq_num
+    assert "throttle_mode must be 'leading' or 'trailing'" in caplog.text
+
+    #
+    # events that don't match the condition don't count
+    #
+    seq_num += 1
+    for arg1 in [1, 0, 2, 0, 3]:
+        hass.bus.async_fire("test_event", {"arg1": arg1})
+    assert literal_eval(await wait_until_done(notify_q)) == [seq_num, 3]
+
+    seq_num += 1
+    for arg1 in [4, 5, 6]:
+        hass.bus.async_fire("test_event", {"arg1": arg1})
+    assert literal_eval(await wait_until_done(notify_q)) == [seq_num, 6]
+
+
+async def test_task_mode(hass, caplog):
+    """Test the single and queued task modes."""
+    notify_q = asyncio.Queue(0)
+    await setup_script(
+        hass,
+        notify_q,
+        [dt(2020, 7, 1, 10, 59, 59, 999999), dt(2020, 7, 1, 11, 59, 59, 999999)],
+        """
+
+seq_num = 0
+
+@time_trigger("once(2020/07/01 11:00:00)")
+def func_startup_sync():
+    global seq_num
+
+    seq_num += 1
+    pyscript.done = seq_num
+
+@event_trigger("test_single")
+@task_mode("single")
+def func_single(arg1=None):
+    global seq_num
+
+    task.wait_until(event_trigger="test_release")
+    seq_num += 1
+    pyscript.done = [seq_num, "single", arg1]
+
+@event_trigger("test_queued")
+@task_mode("queued", max=1)
+def func_queued(arg1=None):
+    global seq_num
+
+    task.wait_until(event_trigger="test_release")
+    seq_num += 1
+    pyscript.done = [seq_num, "queued", arg1]
+
+@task_mode("sometimes")
+def func_bad():
+    pass
+""",
+    )
+    seq_num = 0
+
+    seq_num += 1
+    # fire event to start triggers, and handshake when they are running
+    hass.bus.async_fire(EVENT_HOMEASSISTANT_STARTED)
+    assert literal_eval(await wait_until_done(notify_q)) == seq_num
+    assert "decorator @task_mode takes one argument" in caplog.text
+
+    #
+    # the second call is dropped while the first is running
+    #
+    hass.bus.async_fire("test_single", {"arg1": 1})
+    hass.bus.async_fire("test_single", {"arg1": 2})
+    await hass.async_block_till_done()
+    seq_num += 1
+    hass.bus.async_fire("test_release")
+    assert literal_eval(await wait_until_done(notify_q)) == [seq_num, "single", 1]
+
+    #
+    # the second call is queued, and the third is dropped
+    #
+    hass.bus.async_fire("test_queued", {"arg1": 1})
+    hass.bus.async_fire("test_queued", {"arg1": 2})
+    hass.bus.async_fire("test_queued", {"arg1": 3})
+    await hass.async_block_till_done()
+    seq_num += 1
+    hass.bus.async_fire("test_release")
+    assert literal_eval(await wait_until_done(notify_q)) == [seq_num, "queued", 1]
+    await hass.async_block_till_done()
+    seq_num += 1
+    hass.bus.async_fire("test_release")
+    assert literal_eval(await wait_until_done(notify_q)) == [seq_num, "queued", 2]
+
+
+async def test_task_priority(hass, caplog):
+    """Test that only low_priority_max low priority functions run at once."""
+    notify_q = asyncio.Queue(0)
+    await setup_script(
+        hass,
+        notify_q,
+        [dt(2020, 7, 1, 10, 59, 59, 999999), dt(2020, 7, 1, 11, 59, 59, 999999)],
+        """
+
+seq_num = 0
+running = []
+
+@time_trigger("once(2020/07/01 11:00:00)")
+def func_startup_sync():
+    global seq_num
+
+    seq_num += 1
+    pyscript.done = seq_num
+
+@event_trigger("test_low")
+@task_priority("low")
+def func_low(arg1=None):
+    global seq_num
+
+    running.append(arg1)
+    ret = task.wait_until(event_trigger=["test_release", f"arg1 == {arg1}"])
+    running.remove(ret["arg1"])
+    seq_num += 1
+    pyscript.done = [seq_num, "low", running, task.stats()["action_low_priority_waited"]]
+
+@event_trigger("test_high")
+@task_priority("high")
+def func_high():
+    global seq_num
+
+    seq_num += 1
+    pyscript.done = [seq_num, "high", running]
+
+@task_priority("urgent")
+def func_bad():
+    pass
+""",
+    )
+    seq_num = 0
+
+    seq_num += 1
+    # fire event to start triggers, and handshake when they are running
+    hass.bus.async_fire(EVENT_HOMEASSISTANT_STARTED)
+    assert literal_eval(await wait_until_done(notify_q)) == seq_num
+    assert "decorator @task_priority takes one argument" in caplog.text
+
+    #
+    # only the first four low priority calls start; the high priority one runs
+    #
+    for arg1 in range(6):
+        hass.bus.async_fire("test_low", {"arg1": arg1})
+    await hass.async_block_till_done()
+    seq_num += 1
+    hass.bus.async_fire("test_high")
+    assert literal_eval(await wait_until_done(notify_q)) == [
+        seq_num,
+        "high",
+        [0, 1, 2, 3],
+    ]
+
+    #
+    # once a running call finishes, the first waiting call starts
+    #
+    hass.bus.async_fire("test_release", {"arg1": 2})
+    seq_num += 1
+    assert literal_eval(await wait_until_done(notify_q)) == [
+        seq_num,
+        "low",
+        [0, 1, 3],
+        2,
+    ]
+    await hass.async_block_till_done()
+    hass.bus.async_fire("test_release", {"arg1": 4})
+    seq_num += 1
+    assert literal_eval(await wait_until_done(notify_q)) == [
+        seq_num,
+        "low",
+        [0, 1, 3],
+        2,
+    ]
+
+
+async def test_event_state_stream(hass, caplog):
+    """Test iterating over event and state streams."""
+    notify_q = asyncio.Queue(0)
+    await setup_script(
+        hass,
+        notify_q,
+        [dt(2020, 7, 1, 10, 59, 59, 999999), dt(2020, 7, 1, 11, 59, 59, 999999)],
+        """
+
+seq_num = 0
+
+@time_trigger("once(2020/07/01 11:00:00)")
+def func_startup_sync():
+    global seq_num
+
+    seq_num += 1
+    pyscript.done = seq_num
+
+@event_trigger("test_event_stream")
+def func_event_stream():
+    global seq_num
+
+    stream = event.stream("test_event", maxlen=2)
+    seq_num += 1
+    pyscript.done = seq_num
+    got = []
+    for evt in stream:
+        got.append(evt["arg1"])
+        if evt["arg1"] == 0:
+            task.wait_until(event_trigger="test_release")
+        if len(got) == 3:
+            break
+    stream.close()
+    seq_num += 1
+    pyscript.done = [seq_num, got, stream.dropped]
+
+@event_trigger("test_state_stream")
+def func_state_stream():
+    global seq_num
+
+    stream = state.stream(["pyscript.a*"])
+    seq_num += 1
+    pyscript.done = seq_num
+    got = []
+    for value in stream:
+        got.append([value["var_name"], value["value"]])
+        if len(got) == 2:
+            stream.close()
+    else:
+        seq_num += 1
+        pyscript.done = [seq_num, got]
+""",
+    )
+    seq_num = 0
+
+    seq_num += 1
+    # fire event to start triggers, and handshake when they are running
+    hass.bus.async_fire(EVENT_HOMEASSISTANT_STARTED)
+    assert literal_eval(await wait_until_done(notify_q)) == seq_num
+
+    #
+    # events that arrive while the stream is busy are buffered, and the
+    # oldest are dropped when the buffer is full
+    #
+    seq_num += 1
+    hass.bus.async_fire("test_event_stream")
+    assert literal_eval(await wait_until_done(notify_q)) == seq_num
+    for arg1 in range(5):
+        hass.bus.async_fire("test_event", {"arg1": arg1})
+    await hass.async_block_till_done()
+    hass.bus.async_fire("test_release")
+    seq_num += 1
+    assert literal_eval(await wait_until_done(notify_q)) == [seq_num, [0, 3, 4], 2]
+
+    seq_num += 1
+    hass.bus.async_fire("test_state_stream")
+    assert literal_eval(await wait_until_done(notify_q)) == seq_num
+    hass.states.async_set("pyscript.a1", 1)
+    hass.states.async_set("pyscript.b1", 2)
+    hass.states.async_set("pyscript.a2", 3)
+    seq_num += 1
+    assert literal_eval(await wait_until_done(notify_q)) == [
+        seq_num,
+        [["pyscript.a1", "1"], ["pyscript.a2", "3"]],
+    ]
+
+
+async def test_stream_drain(hass, caplog):
+    """Test draining batches of events from a stream."""
+    notify_q = asyncio.Queue(0)
+    await setup_script(
+        hass,
+        notify_q,
+        [dt(2020, 7, 1, 10, 59, 59, 999999), dt(2020, 7, 1, 11, 59, 59, 999999)],
+        """
+
+seq_num = 0
+
+@time_trigger("once(2020/07/01 11:00:00)")
+def func_startup_sync():
+    global seq_num
+
+    stream = event.stream("test_event")
+    seq_num += 1
+    pyscript.done = seq_num
+    task.wait_until(event_trigger="test_release")
+    batches = [stream.drain(max_items=3), stream.drain(max_items=3, max_wait=0.05)]
+    stream.close()
+    batches.append(stream.drain())
+    seq_num += 1
+    pyscript.done = [seq_num, batches]
+""",
+    )
+    seq_num = 0
+
+    seq_num += 1
+    # fire event to start triggers, and handshake when they are running
+    hass.bus.async_fire(EVENT_HOMEASSISTANT_STARTED)
+    assert literal_eval(await wait_until_done(notify_q)) == seq_num
+
+    for arg1 in range(5):
+        hass.bus.async_fire("test_event", {"arg1": arg1})
+    await hass.async_block_till_done()
+    hass.bus.async_fire("test_release")
+    seq_num += 1
+    batches = literal_eval(await wait_until_done(notify_q))[1]
+    assert [[evt["arg1"] for evt in batch] for batch in batches] == [
+        [0, 1, 2],
+        [3, 4],
+        [],
+    ]
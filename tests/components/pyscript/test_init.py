@@ -88,8 +88,14 @@ def func4():
 @service("too many args")
 def func5():
     pass
+
+@state_trigger("pyscript.a == '1'", "too many args", throttle=1)
+def func6():
+    pyscript.func6_ran = 1
 """,
     )
+    hass.bus.async_fire(EVENT_HOMEASSISTANT_STARTED)
+    await hass.async_block_till_done()
     assert hass.services.has_service("pyscript", "func1")
     assert hass.services.has_service("pyscript", "reload")
     assert not hass.services.has_service("pyscript", "func2")
@@ -105,6 +111,15 @@ def func5():
         "func5 defined in /some/config/dir/pyscript/hello.py: decorator @service takes no arguments; ignored"
         in caplog.text
     )
+    #
+    # a rejected trigger decorator with keyword arguments doesn't leave a
+    # trigger-less function that runs at startup
+    #
+    assert (
+        "func6 defined in /some/config/dir/pyscript/hello.py decorator @state_trigger got 2 arguments, expected 1; ignored"
+        in caplog.text
+    )
+    assert hass.states.get("pyscript.func6_ran") is None
 
 
 async def test_service_description(hass):
@@ -1,5 +1,6 @@
 """Unit tests for Python interpreter."""
 import asyncio
+from types import MappingProxyType
 
 from homeassistant.components.pyscript.eval import AstEval
 import homeassistant.components.pyscript.handler as handler
@@ -485,3 +486,127 @@ def test_eval_exceptions(hass):
 
     for test_data in evalTestsExceptions:
         asyncio.run(run_one_test_exception(test_data, state_func, handler_func))
+
+
+stateNamesTests = [
+    ["pyscript.var1 == '1'", ["pyscript.var1"]],
+    [
+        "float(sensor.temp) > 20 and sensor.temp.old != sensor.temp2.attr1",
+        ["sensor.temp", "sensor.temp.old", "sensor.temp2.attr1"],
+    ],
+    ["log.info(sensor.temp) or state.get('sensor.temp3')", ["sensor.temp"]],
+    ["math.sqrt(int(pyscript.var2)) > x.y", ["pyscript.var2"]],
+    ["bytes.fromhex(pyscript.var3)", ["pyscript.var3"]],
+    ["int('1').real or True", []],
+    [
+        "window.avg('sensor.power', '5min') > 100 and window.max(x.y, 10) > 1",
+        ["sensor.power"],
+    ],
+]
+
+
+def test_state_names(hass):
+    """Test finding just the state variables in an expression."""
+    handler_func = handler.Handler(hass)
+    state_func = state.State(hass, handler_func)
+    state_func.register_functions()
+
+    for test_data in stateNamesTests:
+        source, expect = test_data
+        ast = AstEval(
+            "test",
+            global_sym_table={"math": object(), "x": object()},
+            state_func=state_func,
+            handler_func=handler_func,
+        )
+        handler_func.install_ast_funcs(ast)
+        ast.parse(source)
+        assert ast.ast_get_state_names() == expect
+
+
+indexCondsTests = [
+    ["domain == 'light'", {"domain": {"light"}}],
+    [
+        "domain == 'light' and service in ('turn_on', 'toggle') and x > 1",
+        {"domain": {"light"}, "service": {"turn_on", "toggle"}},
+    ],
+    ["'zha' == domain and 10 == arg", {"domain": {"zha"}, "arg": {10}}],
+    ["domain == 'light' or service == 'turn_on'", {}],
+    ["domain == my_domain and service == 'on'", {"service": {"on"}}],
+    ["my_domain == 'light' and len == 1", {}],
+    ["domain != 'light' and service in ['x', 'y']", {"service": {"x", "y"}}],
+    ["data == {'a': 1}", {}],
+]
+
+
+def test_index_conds(hass):
+    """Test finding the indexable conditions in an event trigger expression."""
+    handler_func = handler.Handler(hass)
+    state_func = state.State(hass, handler_func)
+    state_func.register_functions()
+
+    for test_data in indexCondsTests:
+        source, expect = test_data
+        ast = AstEval(
+            "test",
+            global_sym_table={"my_domain": "light"},
+            state_func=state_func,
+            handler_func=handler_func,
+        )
+        handler_func.install_ast_funcs(ast)
+        ast.parse(source)
+        assert ast.ast_get_index_conds() == expect
+
+
+stateOnlyTests = [
+    ["input_boolean.enabled == 'on'", True],
+    ["int(sensor.temp) > 20 and sensor.temp.old != sensor.temp2.attr1", True],
+    ["bytes.fromhex(pyscript.var3) and sensor.x.lower() == 'on'", True],
+    ["sensor.temp > x", False],
+    ["math.sqrt(float(sensor.temp)) > 1", False],
+    ["log.info(sensor.temp)", False],
+    ["any(s == 'on' for s in [sensor.a, sensor.b])", False],
+    ["len == 1", False],
+    ["x = sensor.temp", False],
+]
+
+
+def test_state_only(hass):
+    """Test whether an expression only depends on state variables."""
+    handler_func = handler.Handler(hass)
+    state_func = state.State(hass, handler_func)
+    state_func.register_functions()
+
+    for test_data in stateOnlyTests:
+        source, expect = test_data
+        ast = AstEval(
+            "test",
+            global_sym_table={"math": object(), "len": object()},
+            state_func=state_func,
+            handler_func=handler_func,
+        )
+        handler_func.install_ast_funcs(ast)
+        ast.parse(source)
+        assert ast.ast_state_only() == expect
+
+
+def test_eval_shared_kwargs(hass):
+    """Test calling a function with shared, read-only kwargs doesn't modify them."""
+    handler_func = handler.Handler(hass)
+    state_func = state.State(hass, handler_func)
+    state_func.register_functions()
+
+    ast = AstEval("test", state_func=state_func, handler_func=handler_func)
+    handler_func.install_ast_funcs(ast)
+    ast.parse(
+        """
+def func(arg1, **kwargs):
+    kwargs.update({"arg3": arg1 + kwargs.get("arg2")})
+    return kwargs
+"""
+    )
+    asyncio.run(ast.eval())
+    kwargs = MappingProxyType({"arg1": 1, "arg2": 2})
+    result = asyncio.run(ast.global_sym_table["func"].call(ast, kwargs=kwargs))
+    assert result == {"arg2": 2, "arg3": 3}
+    assert kwargs == {"arg1": 1, "arg2": 2}
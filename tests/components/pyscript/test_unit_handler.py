@@ -0,0 +1,86 @@
+"""Unit tests for handler functions."""
+import asyncio
+
+import homeassistant.components.pyscript.handler as handler
+
+
+def state_notify(var_name, value):
+    """Return a state notification queue message."""
+    return ["state", [{var_name: value}, {"var_name": var_name, "value": value}]]
+
+
+def test_notify_queue_unbounded(hass):
+    """Test the default notification queue keeps everything."""
+    handler_func = handler.Handler(hass)
+    notify_q = handler_func.notify_queue()
+    for value in range(5):
+        notify_q.put_nowait(state_notify("sensor.a", value))
+    assert notify_q.qsize() == 5
+    assert handler_func.task_stats()["notify_coalesced"] == 0
+    assert handler_func.task_stats()["notify_dropped"] == 0
+
+
+def test_notify_queue_bounded(hass):
+    """Test a bounded notification queue coalesces state changes and drops the oldest."""
+    handler_func = handler.Handler(hass, notify_queue_max=3)
+    notify_q = handler_func.notify_queue()
+    for value in range(5):
+        notify_q.put_nowait(state_notify("sensor.a", value))
+    notify_q.put_nowait(state_notify("sensor.b", 1))
+    assert notify_q.qsize() == 2
+    for arg1 in range(3):
+        notify_q.put_nowait(["event", {"arg1": arg1}])
+    assert notify_q.qsize() == 3
+    assert handler_func.task_stats()["notify_coalesced"] == 4
+    assert handler_func.task_stats()["notify_dropped"] == 2
+    assert [notify_q.get_nowait() for _ in range(3)] == [
+        ["event", {"arg1": 0}],
+        ["event", {"arg1": 1}],
+        ["event", {"arg1": 2}],
+    ]
+
+    #
+    # once a state change has been taken off the queue, a new one is queued
+    #
+    notify_q.put_nowait(state_notify("sensor.a", 6))
+    assert notify_q.get_nowait() == state_notify("sensor.a", 6)
+    notify_q.put_nowait(state_notify("sensor.a", 7))
+    assert notify_q.qsize() == 1
+
+
+def test_notify_queue_lagging(hass):
+    """Test an unbounded notification queue coalesces state changes only while lagging."""
+    handler_func = handler.Handler(hass, lag_max=0.5)
+    notify_q = handler_func.notify_queue()
+    handler_func.loop_lag = 1
+    assert handler_func.lagging()
+    for value in range(3):
+        notify_q.put_nowait(state_notify("sensor.a", value))
+    assert notify_q.qsize() == 1
+    assert handler_func.task_stats()["notify_coalesced"] == 2
+    assert handler_func.task_stats()["loop_lag"] == 1
+
+    handler_func.loop_lag = 0.1
+    assert not handler_func.lagging()
+    notify_q.put_nowait(state_notify("sensor.b", 0))
+    notify_q.put_nowait(state_notify("sensor.b", 1))
+    assert notify_q.qsize() == 3
+    assert notify_q.get_nowait() == state_notify("sensor.a", 2)
+
+
+async def test_task_priority_order(hass):
+    """Test tasks created at the same time start in priority order."""
+    handler_func = handler.Handler(hass)
+    handler_func.task_priority_set("func_high", "high")
+    handler_func.task_priority_set("func_low", "low")
+    started = []
+
+    async def func(name):
+        started.append(name)
+
+    tasks = [
+        handler_func.create_task(func(name), name)
+        for name in ["func_low", "func_normal", "func_high", "func_normal2"]
+    ]
+    await asyncio.gather(*tasks)
+    assert started == ["func_high", "func_normal", "func_normal2", "func_low"]
@@ -0,0 +1,346 @@
+"""Unit tests for state functions."""
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+from homeassistant.components.pyscript.eval import AstEval
+import homeassistant.components.pyscript.event as event
+import homeassistant.components.pyscript.handler as handler
+import homeassistant.components.pyscript.state as state
+from homeassistant.const import EVENT_STATE_CHANGED
+from homeassistant.exceptions import (
+    HomeAssistantError,
+    InvalidEntityFormatError,
+    InvalidStateError,
+)
+
+from tests.async_mock import MagicMock, patch
+
+
+def test_glob_rewrite():
+    """Test wildcard state variables are rewritten, except inside strings."""
+    assert (
+        state.State.glob_rewrite("binary_sensor.door_* == 'on' or light.*.brightness")
+        == "binary_sensor.door___glob__ == 'on' or light.__glob__.brightness"
+    )
+    assert (
+        state.State.glob_rewrite("sensor.t_* != \"sensor.*\" and x == 'light.a*'")
+        == "sensor.t___glob__ != \"sensor.*\" and x == 'light.a*'"
+    )
+    assert state.State.glob_rewrite(["light.* == 'on'", "'light.*'"]) == [
+        "light.__glob__ == 'on'",
+        "'light.*'",
+    ]
+    assert state.State.glob_rewrite("sensor.x * 2 > 5") == "sensor.x * 2 > 5"
+    assert state.State.glob_rewrite("sensor.x*.5 > 3") == "sensor.x*.5 > 3"
+
+
+def state_changed_event(entity_id):
+    """Return a state_changed event for entity_id."""
+    return SimpleNamespace(
+        data={"entity_id": entity_id, "new_state": None, "old_state": None}
+    )
+
+
+def test_notify_listen(hass):
+    """Test the state_changed listener is only attached while something is watched."""
+    handler_func = handler.Handler(hass)
+    state_func = state.State(hass, handler_func)
+
+    with patch.object(hass.bus, "async_listen", return_value=MagicMock()) as listen:
+        remove = listen.return_value
+        state_func.notify_add(["sensor.a"], "queue1")
+        listen.assert_called_once_with(EVENT_STATE_CHANGED, state_func.state_changed)
+        state_func.notify_add(["sensor.b.attr1", "sensor.c"], "queue2")
+        assert listen.call_count == 1
+
+        state_func.notify_del(["sensor.a"], "queue1")
+        assert remove.call_count == 0
+        state_func.notify_del(["sensor.b.attr1", "sensor.c"], "queue2")
+        assert remove.call_count == 1
+        assert state_func.notify == {}
+        assert state_func.notify_remove is None
+
+
+def test_state_changed_prefilter(hass):
+    """Test state changes of variables nobody watches don't create a task."""
+    handler_func = handler.Handler(hass)
+    state_func = state.State(hass, handler_func)
+    state_func.notify_add(["sensor.a", "binary_sensor.door_*"], "queue")
+
+    with patch.object(
+        handler_func, "create_task", side_effect=lambda coro: coro.close()
+    ) as create_task:
+        for entity_id in ["sensor.b", "binary_sensor.window", "light.door_1"]:
+            state_func.state_changed(state_changed_event(entity_id))
+        assert create_task.call_count == 0
+
+        state_func.state_changed(state_changed_event("sensor.a"))
+        assert create_task.call_count == 1
+        state_func.state_changed(state_changed_event("binary_sensor.door_1"))
+        assert create_task.call_count == 2
+    state_func.notify_del(["sensor.a", "binary_sensor.door_*"], "queue")
+
+
+def test_state_window():
+    """Test the rolling window samples and discarding old ones."""
+    window = state.StateWindow()
+    #
+    # samples are only kept for the longest period asked for
+    #
+    assert len(window.samples(0, 15)[1]) == 0
+    for time_now, value in [(0, 1), (10, 2), (20, 3), (30, 4)]:
+        window.add(time_now, value)
+    assert list(window.samples(30, 15)[1]) == [3, 4]
+    assert list(window.samples(30, 15)[0]) == [20, 30]
+
+    #
+    # with nothing recent, the value in effect is returned unless current is False
+    #
+    assert list(window.samples(100, 15)[1]) == [4]
+    assert list(window.samples(100, 15, current=False)[1]) == []
+
+    #
+    # samples more than 15 secs old are discarded, except the value in
+    # effect 15 secs ago
+    #
+    window.add(40, 5)
+    assert list(window.samples(40, 100)[1]) == [3, 4, 5]
+
+
+def test_window_functions(hass):
+    """Test the window functions."""
+    handler_func = handler.Handler(hass)
+    state_func = state.State(hass, handler_func)
+    state_func.register_functions()
+
+    hass.states.async_set("sensor.power", "10")
+    with patch("homeassistant.components.pyscript.state.time.time") as time_mock:
+        time_mock.return_value = 1000.0
+        state_func.window_samples("sensor.power", 60)
+        hass.states.async_set("sensor.power", "unavailable")
+        for time_now, value in [(1010.0, 20), (1020.0, 60)]:
+            time_mock.return_value = time_now
+            old_state = hass.states.get("sensor.power")
+            hass.states.async_set("sensor.power", value)
+            state_func.window_update(
+                "sensor.power", hass.states.get("sensor.power"), old_state
+            )
+        time_mock.return_value = 1030.0
+        assert state_func.window_avg("sensor.power", "1min") == 30
+        #
+        # the average is weighted by how long each value was in effect
+        #
+        assert abs(state_func.window_avg("sensor.power", 15) - 700 / 15) < 1e-9
+        assert state_func.window_min("sensor.power", 60) == 10
+        assert state_func.window_max("sensor.power", 60) == 60
+        assert state_func.window_count("sensor.power", 15) == 1
+        assert state_func.window_rate("sensor.power", 25) == 4
+        assert state_func.window_rate("sensor.power", 15) is None
+
+    #
+    # reloading scripts discards their windows
+    #
+    state_func.windows_clear()
+    assert state_func.windows == {}
+    assert state_func.notify_remove is None
+
+
+def test_window_numeric_helpers(hass):
+    """Test the window array, std, slope and ewma functions without numpy."""
+    handler_func = handler.Handler(hass)
+    state_func = state.State(hass, handler_func)
+    state_func.register_functions()
+
+    hass.states.async_set("sensor.energy", "0")
+    with patch("homeassistant.components.pyscript.state.time.time") as time_mock:
+        time_mock.return_value = 1000.0
+        state_func.window_samples("sensor.energy", 60)
+        for time_now, value in [(1010.0, 20), (1020.0, 40), (1030.0, 60)]:
+            time_mock.return_value = time_now
+            old_state = hass.states.get("sensor.energy")
+            hass.states.async_set("sensor.energy", value)
+            state_func.window_update(
+                "sensor.energy", hass.states.get("sensor.energy"), old_state
+            )
+        assert list(state_func.window_array("sensor.energy", 60)) == [0, 20, 40, 60]
+        assert abs(state_func.window_std("sensor.energy", 60) - 500**0.5) < 1e-9
+        assert abs(state_func.window_slope("sensor.energy", 60) - 2) < 1e-9
+        assert state_func.window_ewma("sensor.energy", 60, alpha=0.5) == 42.5
+        assert state_func.window_slope("sensor.energy", 5) is None
+
+
+def test_getf(hass):
+    """Test state.getf parses typed values once per state change."""
+    handler_func = handler.Handler(hass)
+    state_func = state.State(hass, handler_func)
+    state_func.register_functions()
+
+    hass.states.async_set("sensor.temp", "21.5", {"battery": 80})
+    assert state_func.getf("sensor.temp") == 21.5
+    assert state_func.getf("sensor.temp.battery") == 80.0
+    parsed = state_func.parsed[("sensor.temp", None)]
+    assert state_func.getf("sensor.temp") == 21.5
+    assert state_func.parsed[("sensor.temp", None)] is parsed
+
+    hass.states.async_set("sensor.temp", "22", {"battery": 80})
+    assert state_func.getf("sensor.temp") == 22
+    assert isinstance(state_func.getf("sensor.temp"), int)
+    assert state_func.parsed[("sensor.temp", None)] is not parsed
+
+    hass.states.async_set("binary_sensor.door", "on", {"flag": False})
+    assert state_func.getf("binary_sensor.door") is True
+    assert state_func.getf("binary_sensor.door.flag") is False
+    hass.states.async_set("binary_sensor.door", "OFF")
+    assert state_func.getf("binary_sensor.door") is False
+    hass.states.async_set("binary_sensor.door", "1e3")
+    assert state_func.getf("binary_sensor.door") == 1000.0
+
+    hass.states.async_set("sensor.temp", "unavailable")
+    assert state_func.getf("sensor.temp") is None
+    assert state_func.getf("sensor.temp", 0) == 0
+    assert state_func.getf("sensor.missing", -1) == -1
+
+
+def test_names_query(hass):
+    """Test state.names and state.query use the domain index."""
+    handler_func = handler.Handler(hass)
+    state_func = state.State(hass, handler_func)
+    state_func.register_functions()
+
+    hass.states.async_set("light.a", "on", {"brightness": 150})
+    hass.states.async_set("light.b", "on", {"brightness": 50})
+    hass.states.async_set("light.c", "off")
+    hass.states.async_set("switch.x", "on")
+    assert state_func.names("light") == ["light.a", "light.b", "light.c"]
+    assert state_func.names() == ["light.a", "light.b", "light.c", "switch.x"]
+    assert state_func.names("sensor") == []
+
+    #
+    # once built, the index is updated incrementally
+    #
+    with patch.object(hass.states, "async_all") as async_all:
+        state_func.set("light.d", "on", {"brightness": 255})
+        state_func.domains_update("light.a", None)
+        assert state_func.names("light") == ["light.b", "light.c", "light.d"]
+        assert async_all.call_count == 0
+    #
+    # pending writes are seen without being made early
+    #
+    assert "light.d" in state_func.set_pending
+
+    ast = AstEval(
+        "test", {"threshold": 100}, state_func=state_func, handler_func=handler_func
+    )
+    handler_func.install_ast_funcs(ast)
+    query = ast.local_sym_table["state.query"]
+    assert asyncio.run(query("light", "brightness > threshold")) == ["light.d"]
+    assert asyncio.run(query(domain="light", where="value == 'on'")) == [
+        "light.b",
+        "light.d",
+    ]
+    assert asyncio.run(query(where="entity_id.startswith('switch.')")) == ["switch.x"]
+    assert "light.d" in state_func.set_pending
+
+    #
+    # an entity the expression can't be evaluated for doesn't match
+    #
+    state_func.set("light.e", "on", {"brightness": None})
+    with patch(
+        "homeassistant.components.pyscript.eval._LOGGER.error"
+    ) as log_error, patch.object(state._LOGGER, "debug") as log_debug:
+        assert asyncio.run(query("light", "brightness > 100")) == ["light.d"]
+        assert log_error.call_count == 0
+        assert log_debug.call_count == 1
+        assert log_debug.call_args[0][1] == "light.e"
+
+
+def test_state_set_coalesce(hass):
+    """Test state.set suppresses identical writes and coalesces the rest."""
+    handler_func = handler.Handler(hass)
+    state_func = state.State(hass, handler_func)
+    state_func.register_functions()
+
+    hass.states.async_set("pyscript.x", "1", {"attr1": 2})
+    state_func.set("pyscript.x", 1, {"attr1": 2})
+    assert handler_func.stats["state_set_suppressed"] == 1
+    assert len(state_func.set_pending) == 0
+
+    with patch.object(hass.states, "async_set") as async_set:
+        state_func.set("pyscript.x", 2)
+        state_func.set("pyscript.x", 3, {"attr1": 4})
+        state_func.set("pyscript.y", "on")
+        state_func.set("pyscript.x", 3, {"attr1": 4})
+        assert handler_func.stats["state_set_coalesced"] == 1
+        assert handler_func.stats["state_set_suppressed"] == 2
+        assert async_set.call_count == 0
+        #
+        # reads see the pending writes
+        #
+        assert state_func.get("pyscript.x") == "3"
+        assert state_func.get("pyscript.x.attr1") == 4
+        assert state_func.exist("pyscript.y")
+        assert state_func.getf("pyscript.x") == 3.0
+
+        state_func.set_flush()
+        assert async_set.call_count == 2
+        async_set.assert_any_call("pyscript.x", "3", {"attr1": 4})
+        async_set.assert_any_call("pyscript.y", "on", {})
+    assert len(state_func.set_pending) == 0
+    assert state_func.set_handle is None
+
+    #
+    # values hass would reject raise in the caller, and a write that fails
+    # anyway doesn't stop the rest of the batch
+    #
+    with pytest.raises(InvalidEntityFormatError):
+        state_func.set("pyscript.bad name", 1)
+    with pytest.raises(InvalidStateError):
+        state_func.set("pyscript.x", "x" * 256)
+    assert len(state_func.set_pending) == 0
+
+    async_set_orig = hass.states.async_set
+
+    def async_set_fail(var_name, *args):
+        if var_name == "pyscript.b":
+            raise HomeAssistantError("write failed")
+        async_set_orig(var_name, *args)
+
+    state_func.set("pyscript.a", 1)
+    state_func.set("pyscript.b", 2)
+    state_func.set("pyscript.c", 3)
+    with patch.object(
+        hass.states, "async_set", side_effect=async_set_fail
+    ), patch.object(state._LOGGER, "error") as log_error:
+        state_func.set_flush()
+        assert log_error.call_count == 1
+    assert hass.states.get("pyscript.a").state == "1"
+    assert hass.states.get("pyscript.b") is None
+    assert hass.states.get("pyscript.c").state == "3"
+
+
+async def test_stream_task_cancel(hass):
+    """Test streams are unsubscribed when the task that created them is cancelled."""
+    handler_func = handler.Handler(hass)
+    state_func = state.State(hass, handler_func)
+    event_func = event.Event(hass, handler_func)
+
+    async def consume(stream_func, arg):
+        async for _ in stream_func(arg):
+            pass
+
+    tasks = [
+        hass.loop.create_task(consume(state_func.stream, "sensor.a")),
+        hass.loop.create_task(consume(event_func.stream, "test_event")),
+    ]
+    await asyncio.sleep(0)
+    assert "sensor.a" in state_func.notify
+    assert "test_event" in event_func.notify
+
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await asyncio.sleep(0)
+    assert state_func.notify == {}
+    assert event_func.notify == {}
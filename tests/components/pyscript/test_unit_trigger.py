@@ -1,10 +1,13 @@
 """Unit tests for time trigger functions."""
-from datetime import datetime as dt
+from datetime import datetime as dt, timedelta
+from types import SimpleNamespace
 
+from homeassistant.components.pyscript.eval import AstEval
 import homeassistant.components.pyscript.handler as handler
+import homeassistant.components.pyscript.state as state
 import homeassistant.components.pyscript.trigger as trigger
 
-from tests.async_mock import patch
+from tests.async_mock import MagicMock, patch
 
 parseDateTimeTests = [
     ["2019/9/12 13:45", 0, dt(2019, 9, 12, 13, 45, 0, 0)],
@@ -102,6 +105,37 @@ async def test_parse_date_time(hass):
             assert out == expect
 
 
+async def test_sun_cache(hass):
+    """Check sunrise/sunset times are cached per day and flushed on config change."""
+    hass.config.latitude = 54
+    hass.config.longitude = 0
+    hass.config.elevation = 0
+    hass.config.time_zone = "GMT"
+
+    handler_func = handler.Handler(hass)
+    trig = trigger.TrigTime(hass, handler_func)
+
+    now = dt(2019, 9, 1, 13, 0, 0, 0)
+    sunrise = dt(2019, 9, 1, 6, 39, 6, 0)
+
+    with patch(
+        "homeassistant.helpers.sun.get_astral_event_date", return_value=sunrise
+    ) as mock_sun:
+        for _ in range(3):
+            trig.parse_date_time("sunrise", 0, now)
+            trig.timer_active_check("range(sunrise, sunrise + 1hr)", now)
+        assert mock_sun.call_count == 1
+
+        trig.parse_date_time("sunrise", 1, now)
+        trig.parse_date_time("sunset", 0, now)
+        assert mock_sun.call_count == 3
+
+        hass.bus.async_fire("core_config_updated", {})
+        await hass.async_block_till_done()
+        trig.parse_date_time("sunrise", 0, now)
+        assert mock_sun.call_count == 4
+
+
 timerActiveCheckTests = [
     [["range(2019/9/1 8:00, 2019/9/1 18:00)"], dt(2019, 8, 31, 8, 0, 0, 0), False],
     [["range(2019/9/1 8:00, 2019/9/1 18:00)"], dt(2019, 9, 1, 7, 59, 59, 0), False],
@@ -403,3 +437,234 @@ def test_timer_trigger_next_month_rollover(hass):
             t_next = trig.timer_trigger_next(spec, now)
             assert t_next == expect
             now = t_next
+
+
+async def test_trig_expr_memo(hass):
+    """Test shared trigger expressions only evaluate terms whose state variables changed."""
+    handler_func = handler.Handler(hass)
+    state_func = state.State(hass, handler_func)
+    trig_time = trigger.TrigTime(hass, handler_func)
+
+    def make_expr(code):
+        ast_ctx = AstEval("test", state_func=state_func, handler_func=handler_func)
+        handler_func.install_ast_funcs(ast_ctx)
+        ast_ctx.parse(code)
+        return trig_time.expr_share(ast_ctx)
+
+    expr = make_expr("sensor.a == 'on' and sensor.b.attr1 == 1")
+    assert isinstance(expr, trigger.TrigExpr)
+    assert make_expr("sensor.a=='on' and (sensor.b.attr1 == 1)") is expr
+    assert not isinstance(make_expr("sensor.a == x"), trigger.TrigExpr)
+
+    expr.start()
+    hass.states.async_set("sensor.a", "on")
+    hass.states.async_set("sensor.b", "on", {"attr1": 1})
+    evals = []
+    aeval = expr.ast_ctx.aeval
+
+    async def aeval_count(arg, undefined_check=True):
+        if arg in [term[0] for term in expr.terms]:
+            evals.append(arg)
+        return await aeval(arg, undefined_check=undefined_check)
+
+    with patch.object(expr.ast_ctx, "aeval", aeval_count):
+        assert await expr.eval() is True
+        assert len(evals) == 2
+        assert await expr.eval() is True
+        assert len(evals) == 2
+
+        #
+        # changing the state of sensor.b doesn't change sensor.b.attr1
+        #
+        state_func.version_bump(
+            "sensor.b",
+            hass.states.get("sensor.b"),
+            hass.states.get("sensor.b"),
+        )
+        assert await expr.eval() is True
+        assert len(evals) == 2
+
+        state_func.set("sensor.a", "off")
+        assert await expr.eval() == 0
+        assert len(evals) == 3
+
+    #
+    # the version is bumped as soon as the state_changed event arrives
+    #
+    version = state_func.version_get(["sensor.b.attr1"])
+    old_state = hass.states.get("sensor.b")
+    hass.states.async_set("sensor.b", "on", {"attr1": 2})
+    event = SimpleNamespace(
+        data={
+            "entity_id": "sensor.b",
+            "old_state": old_state,
+            "new_state": hass.states.get("sensor.b"),
+        }
+    )
+    with patch.object(
+        handler_func, "create_task", side_effect=lambda coro: coro.close()
+    ):
+        state_func.state_changed(event)
+    assert state_func.version_get(["sensor.b.attr1"]) != version
+
+    #
+    # notified values don't outlive the evaluation they were passed to
+    #
+    await expr.eval({"sensor.b.attr1": 2})
+    assert expr.ast_ctx.notify_vars == {"sensor.b.attr1": 2}
+    await expr.eval()
+    assert expr.ast_ctx.notify_vars is None
+    expr.stop()
+    assert state_func.version == {}
+
+
+def test_wait_expr_cache(hass):
+    """Test task.wait_until conditions are parsed once and their contexts reused."""
+    handler_func = handler.Handler(hass)
+    state_func = state.State(hass, handler_func)
+    trig_time = trigger.TrigTime(hass, handler_func)
+    ast_ctx = AstEval("test", state_func=state_func, handler_func=handler_func)
+
+    entry, expr_ctx = trig_time.wait_expr_get(ast_ctx, "state", "sensor.a == 'on'")
+    assert entry["state_names"] == ["sensor.a"]
+    expr_ctx.notify_vars = {"sensor.a": "on"}
+    trig_time.wait_expr_put(entry, expr_ctx)
+    entry2, expr_ctx2 = trig_time.wait_expr_get(ast_ctx, "state", "sensor.a == 'on'")
+    assert entry2 is entry and expr_ctx2 is expr_ctx
+    assert expr_ctx2.notify_vars is None
+    assert "task.wait_until" in expr_ctx2.local_sym_table
+
+    #
+    # a concurrent waiter gets its own context
+    #
+    _, expr_ctx3 = trig_time.wait_expr_get(ast_ctx, "state", "sensor.a == 'on'")
+    assert expr_ctx3 is not expr_ctx
+
+    entry, _ = trig_time.wait_expr_get(ast_ctx, "event", "arg1 == 5")
+    assert entry["event_conds"] == {"arg1": {5}}
+
+    #
+    # a reloaded function has a new global symbol table
+    #
+    ast_ctx2 = AstEval("test", state_func=state_func, handler_func=handler_func)
+    entry2, expr_ctx4 = trig_time.wait_expr_get(ast_ctx2, "event", "arg1 == 5")
+    assert entry2 is not entry
+    assert expr_ctx4.global_sym_table is ast_ctx2.global_sym_table
+
+    #
+    # reloading scripts discards the cache and its pooled contexts
+    #
+    trig_time.wait_expr_put(entry2, expr_ctx4)
+    trig_time.wait_expr_clear()
+    assert trig_time.wait_expr_cache == {}
+    entry3, expr_ctx5 = trig_time.wait_expr_get(ast_ctx2, "event", "arg1 == 5")
+    assert entry3 is not entry2 and expr_ctx5 is not expr_ctx4
+
+
+async def test_timer(hass):
+    """Test the central timer used by time triggers."""
+    handler_func = handler.Handler(hass)
+    trig_time = trigger.TrigTime(hass, handler_func)
+    now = dt(2020, 7, 1, 12, 0, 0, 0)
+    due1 = now + timedelta(seconds=10)
+    due2 = now + timedelta(seconds=20)
+    calls = []
+
+    def func_factory(key):
+        async def func(time_due):
+            calls.append([key, time_due])
+
+        return func
+
+    with patch(
+        "homeassistant.components.pyscript.trigger.dt_now", return_value=now
+    ), patch.object(hass.loop, "call_later", return_value=MagicMock()) as call_later:
+        #
+        # adding an existing key replaces its due time
+        #
+        trig_time.timer_add("a", due2, func_factory("a"))
+        trig_time.timer_add("a", due1, func_factory("a"))
+        assert list(trig_time.timer_due) == [due1]
+        assert trig_time.timer_key2time == {"a": due1}
+        assert trig_time.timer_handle_time == due1
+
+        #
+        # deleting the earliest timer reschedules the wakeup
+        #
+        trig_time.timer_add("b", due2, func_factory("b"))
+        trig_time.timer_del("a")
+        assert trig_time.timer_handle_time == due2
+        assert call_later.call_args[0][0] == 20
+
+        #
+        # timers due at the same time are dispatched by one wakeup
+        #
+        trig_time.timer_add("c", due2, func_factory("c"))
+        with patch.object(handler_func, "create_task") as create_task:
+            trig_time.timer_wakeup()
+            assert create_task.call_count == 1
+            await create_task.call_args[0][0]
+    assert calls == [["b", due2], ["c", due2]]
+    assert trig_time.timer_due == {}
+    assert trig_time.timer_key2time == {}
+    assert trig_time.timer_handle is None
+
+
+async def test_trig_info_notify(hass, caplog):
+    """Test state and event triggers check their condition inline, and only create a task if it's true."""
+    handler_func = handler.Handler(hass)
+    state_func = state.State(hass, handler_func)
+    trig_time = trigger.TrigTime(hass, handler_func)
+    action = MagicMock()
+
+    trig_event = trigger.TrigInfo(
+        "func_event",
+        {
+            "event_trigger": ["test_event", "1 / arg1 > 0.5"],
+            "action": action,
+            "action_ast_ctx": "event_ctx",
+        },
+        state_func=state_func,
+        handler_func=handler_func,
+        trig_time=trig_time,
+    )
+    trig_state = trigger.TrigInfo(
+        "func_state",
+        {
+            "state_trigger": "int(sensor.a) > 5",
+            "action": action,
+            "action_ast_ctx": "state_ctx",
+        },
+        state_func=state_func,
+        handler_func=handler_func,
+        trig_time=trig_time,
+    )
+
+    with patch.object(handler_func, "create_task") as create_task:
+        #
+        # a false condition doesn't create a task
+        #
+        await trig_event.notify_event({"trigger_type": "event", "arg1": 4})
+        await trig_state.notify_state({"sensor.a": "3"}, {"value": "3"})
+        assert create_task.call_count == 0
+
+        #
+        # a condition that raises is logged, and later events still work
+        #
+        await trig_event.notify_event({"trigger_type": "event", "arg1": 0})
+        await trig_state.notify_state({"sensor.a": "x"}, {"value": "x"})
+        assert create_task.call_count == 0
+        assert "division by zero" in caplog.text
+        assert "invalid literal for int()" in caplog.text
+
+        func_args = {"trigger_type": "event", "arg1": 1}
+        await trig_event.notify_event(func_args)
+        assert create_task.call_count == 1
+        assert create_task.call_args[1] == {"name": "func_event"}
+        action.call.assert_called_with("event_ctx", kwargs=func_args)
+
+        func_args = {"trigger_type": "state", "var_name": "sensor.a", "value": "7"}
+        await trig_state.notify_state({"sensor.a": "7"}, func_args)
+        assert create_task.call_count == 2
+        assert create_task.call_args[1] == {"name": "func_state"}
+        action.call.assert_called_with("state_ctx", kwargs=func_args)